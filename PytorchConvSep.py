@@ -5,7 +5,8 @@ import torch
 from torch.autograd import Variable
 import torch.nn as nn
 from collections import OrderedDict
-from data_pipeline import data_gen
+import collections
+from data_pipeline import BatchLoader, loader_pool_stats
 import matplotlib.pyplot as plt
 import config
 import utils
@@ -214,13 +215,19 @@ def trainNetwork(save_name = 'model_e' + str(config.num_epochs) + '_b' + str(con
 
     count = 0
 
+    train_loader = BatchLoader()
+
+    val_loader = BatchLoader(mode= "Val")
+
     for epoch in range(config.num_epochs):
 
         start_time = time.time()
 
-        generator = data_gen()
+        generator = train_loader
+
+        val_gen = val_loader
 
-        val_gen = data_gen(mode= "Val")
+        wait_time = train_loader.wait_time + val_loader.wait_time
 
         train_loss = 0
         train_loss_vocals = 0
@@ -344,6 +351,8 @@ def trainNetwork(save_name = 'model_e' + str(config.num_epochs) + '_b' + str(con
             print('                                  validation alpha diff: %.7f' % (val_alpha_diff))
             print('                                  validation beta  diff: %.7f' % (val_beta_other))
             print('                                  validation beta2 diff: %.7f' % (val_beta_other_voc))
+            print('                                  waited for data: %.2f seconds' % (train_loader.wait_time + val_loader.wait_time - wait_time))
+            print('                                  hdf5 handles: %(hits)d hits, %(misses)d misses, %(evictions)d evictions' % loader_pool_stats(train_loader, val_loader))
 
         # import pdb;pdb.set_trace()
         if (epoch+1)%config.save_every  == 0:
@@ -353,135 +362,174 @@ def trainNetwork(save_name = 'model_e' + str(config.num_epochs) + '_b' + str(con
         # import pdb;pdb.set_trace()
 
 
+    train_loader.close()
+    val_loader.close()
+
     torch.save(autoencoder.state_dict(), config.log_dir+save_name+'_'+str(epoch + 99)+'.pt')
 
 
-def evalNetwork(file_name, load_name='model_e4000_b50_bs5_1709', plot = False, synth = False):
-    autoencoder_audio = AutoEncoder().cuda()
-    epoch = 50
+def mask_stems(in_batches, out_batches, min_feat_tars, max_feat_tars):
+    """
+    out_drums, out_bass, out_others, out_vocals = mask_stems(in_batches, out_batches, min_feat_tars, max_feat_tars)
 
-    eps=1e-30
+    Splits the normalised mixture chunks in_batches with the ratio masks
+    of the sources estimated by the model in out_batches, and
+    denormalises them. The chunks are on the last four axes, so batches
+    can be given one at a time or stacked.
+    """
+    vocals = out_batches[...,:2,:,:]
 
-    # autoencoder_audio.load_state_dict(torch.load(config.log_dir+load_name+'_'+str(epoch)+'.pt'))
-
-    autoencoder_audio.load_state_dict(torch.load('./log/model_e8000_b50_bs5_3369.pt'))
-    stat_file = h5py.File(config.stat_dir+'stats.hdf5', mode='r')
-    '''
-    import pdb;pdb.set_trace()
-    enc = autoencoder_audio.encoder
-    weight = enc[0].weight.data.cpu().numpy()
-    plt.imshow(weight[0,0,:,:])
-    '''
-    max_feat = np.array(stat_file["feats_maximus"])   
-    min_feat = np.array(stat_file["feats_minimus"])
-
-    max_feat_tars = max_feat[:8,:].reshape(8,1,513)
-    min_feat_tars = min_feat[:8,:].reshape(8,1,513)
-
-    max_feat_ins = max_feat[-2:,:].reshape(2,1,513)
-    min_feat_ins = min_feat[-2:,:].reshape(2,1,513)
+    drums = out_batches[...,2:4,:,:]
 
+    bass = out_batches[...,4:6,:,:]
 
-    audio,fs = stempeg.read_stems(os.path.join(config.wav_dir_test,file_name), stem_id=[0,1,2,3,4])
+    others = out_batches[...,6:,:,:]
 
-    mixture = audio[0]
-
-    drums = audio[1]
-
-    bass = audio[2]
+    total_sources = vocals + bass + drums + others 
 
-    acc = audio[3]
+    mask_vocals = vocals/total_sources
 
-    vocals = audio[4]
+    mask_drums = drums/total_sources
 
-    mix_stft, mix_phase = utils.stft_stereo(mixture,phase=True)
+    mask_bass = bass/total_sources
 
-    mix_stft = (mix_stft-min_feat_ins)/(max_feat_ins-min_feat_ins)
+    mask_others = 1 - (mask_vocals+mask_drums+mask_bass)
 
-    drums_stft = utils.stft_stereo(drums)
+    out_vocals = in_batches * mask_vocals
 
-    bass_stft = utils.stft_stereo(bass)
+    out_drums = in_batches * mask_drums
 
-    acc_stft = utils.stft_stereo(acc)
+    out_bass = in_batches * mask_bass
 
-    voc_stft = utils.stft_stereo(vocals)
+    out_others = in_batches * mask_others
 
-    in_batches, nchunks_in = utils.generate_overlapadd(mix_stft)
+    out_vocals = out_vocals*(max_feat_tars[:2,:,:]-min_feat_tars[:2,:,:])+min_feat_tars[:2,:,:]
 
-    out_batches = []
+    out_drums = out_drums*(max_feat_tars[2:4,:,:]-min_feat_tars[2:4,:,:])+min_feat_tars[2:4,:,:]
 
-    for in_batch in in_batches:
-        # import pdb;pdb.set_trace()
-        in_batch = Variable(torch.FloatTensor(in_batch)).cuda()
-        out_batch = autoencoder_audio(in_batch)
-        out_batches.append(np.array(out_batch.data.cpu().numpy()))
-        
+    out_bass = out_bass*(max_feat_tars[4:6,:,:]-min_feat_tars[4:6,:,:])+min_feat_tars[4:6,:,:]
 
-    out_batches = np.array(out_batches)
-    
-    #out_batches[out_batches == 0] = 1e-6
+    out_others = out_others*(max_feat_tars[6:,:,:]-min_feat_tars[6:,:,:])+min_feat_tars[6:,:,:]
 
-    vocals = out_batches[:,:,:2,:,:]
+    return out_drums, out_bass, out_others, out_vocals
+
+def separate_stream(autoencoder_audio, audio_blocks, min_feat_ins, max_feat_ins, min_feat_tars, max_feat_tars):
+    """
+    Streamed version of the separation of evalNetwork, with the numpy
+    functions of utils: the mixture, given as consecutive audio_blocks of
+    shape (samples, 2) such as the ones utils.read_stem_blocks yields, is
+    transformed, cut into chunks, separated and put back together a block
+    at a time, and (stems, phase) blocks for utils.write_stems_stream are
+    yielded, stems being the drums, bass, others and vocals. Only a few
+    blocks are held whatever the length of the mixture, instead of its
+    whole audio, spectrogram and phase and the spectrograms of every stem.
+    """
+    phases = collections.deque()
+
+    def mix_blocks():
+        for mix_stft, mix_phase in utils.stft_stereo_stream(audio_blocks, phase=True):
+            phases.append(mix_phase)
+            yield (mix_stft-min_feat_ins)/(max_feat_ins-min_feat_ins)
+
+    def stem_batches():
+        for in_batch, nchunks in utils.generate_overlapadd_stream(mix_blocks()):
+            out_batch = utils.from_model(autoencoder_audio(Variable(utils.to_model(in_batch)).cuda()))
+            yield np.stack(mask_stems(in_batch, out_batch, min_feat_tars, max_feat_tars)), nchunks
+
+    return utils.pair_phase(utils.overlapadd_stream(stem_batches()), phases)
+
+def evalNetwork(file_name, load_name='model_e4000_b50_bs5_1709', plot = False, synth = False, autoencoder_audio = None):
+    epoch = 50
 
-    drums = out_batches[:,:,2:4,:,:]
+    eps=1e-30
 
-    bass = out_batches[:,:,4:6,:,:]
+    # autoencoder_audio.load_state_dict(torch.load(config.log_dir+load_name+'_'+str(epoch)+'.pt'))
 
-    others = out_batches[:,:,6:,:,:]
+    if autoencoder_audio is None:
+        autoencoder_audio = AutoEncoder().cuda()
+        autoencoder_audio.load_state_dict(torch.load('./log/model_e8000_b50_bs5_3369.pt'))
+    stat_file = h5py.File(config.stat_dir+'stats.hdf5', mode='r')
+    '''
+    import pdb;pdb.set_trace()
+    enc = autoencoder_audio.encoder
+    weight = enc[0].weight.data.cpu().numpy()
+    plt.imshow(weight[0,0,:,:])
+    '''
+    dsp = utils.get_dsp_backend()
 
-    total_sources = vocals + bass + drums + others 
+    max_feat = dsp.asarray(np.array(stat_file["feats_maximus"]))
+    min_feat = dsp.asarray(np.array(stat_file["feats_minimus"]))
 
-    total_sources = total_sources
+    max_feat_tars = max_feat[:8,:].reshape(8,1,513)
+    min_feat_tars = min_feat[:8,:].reshape(8,1,513)
 
-    mask_vocals = vocals/total_sources
+    max_feat_ins = max_feat[-2:,:].reshape(2,1,513)
+    min_feat_ins = min_feat[-2:,:].reshape(2,1,513)
 
-    mask_drums = drums/total_sources
 
-    mask_bass = bass/total_sources
+    if synth and not plot and config.dsp_backend == 'numpy':
+        # the stems are only written, so the mixture is decoded, separated
+        # and resynthesised synth_block_frames frames at a time
+        audio_blocks = utils.read_stem_blocks(os.path.join(config.wav_dir_test,file_name), 0, config.synth_block_frames*256)
+        utils.write_stems_stream(separate_stream(autoencoder_audio, audio_blocks, min_feat_ins, max_feat_ins, min_feat_tars, max_feat_tars),
+                                 [config.out_dir+file_name+"_"+stem+".wav" for stem in ("drums", "bass", "others", "vocals")])
+        return
 
-    mask_others = 1 - (mask_vocals+mask_drums+mask_bass)
+    # the target stems are only needed for the plots
+    if plot:
+        audio,fs = utils.read_stems(os.path.join(config.wav_dir_test,file_name))
 
-    out_vocals = in_batches * mask_vocals
+        mixture = audio[0]
 
-    out_drums = in_batches * mask_drums
+        drums_stft = dsp.stft_stereo(audio[1])
 
-    out_bass = in_batches * mask_bass
+        bass_stft = dsp.stft_stereo(audio[2])
 
-    out_others = in_batches * mask_others
-    
+        acc_stft = dsp.stft_stereo(audio[3])
 
-    out_vocals = out_vocals*(max_feat_tars[:2,:,:]-min_feat_tars[:2,:,:])+min_feat_tars[:2,:,:]
+        voc_stft = dsp.stft_stereo(audio[4])
+    else:
+        mixture,fs = utils.read_stems(os.path.join(config.wav_dir_test,file_name),stem_id=0)
 
-    out_drums = out_drums*(max_feat_tars[2:4,:,:]-min_feat_tars[2:4,:,:])+min_feat_tars[2:4,:,:]
+    mix_stft, mix_phase = dsp.stft_stereo(mixture,phase=True)
 
-    out_bass = out_bass*(max_feat_tars[4:6,:,:]-min_feat_tars[4:6,:,:])+min_feat_tars[4:6,:,:]
+    mix_stft = (mix_stft-min_feat_ins)/(max_feat_ins-min_feat_ins)
 
-    out_others = out_others*(max_feat_tars[6:,:,:]-min_feat_tars[6:,:,:])+min_feat_tars[6:,:,:]
+    in_batches, nchunks_in = dsp.generate_overlapadd(mix_stft)
 
+    out_batches = []
 
-    
-    out_drums = utils.overlapadd(out_drums, nchunks_in) 
+    for in_batch in in_batches:
+        # import pdb;pdb.set_trace()
+        in_batch = Variable(dsp.to_model(in_batch)).cuda()
+        out_batch = autoencoder_audio(in_batch)
+        out_batches.append(dsp.from_model(out_batch))
+        
 
-    out_bass = utils.overlapadd(out_bass, nchunks_in) 
+    out_batches = dsp.stack(out_batches)
 
-    out_others = utils.overlapadd(out_others, nchunks_in) 
+    out_stems = mask_stems(in_batches, out_batches, min_feat_tars, max_feat_tars)
 
-    out_vocals = utils.overlapadd(out_vocals, nchunks_in) 
+    out_drums, out_bass, out_others, out_vocals = dsp.overlapadd(dsp.stack(out_stems), nchunks_in)
 
     if plot:
+        # numpy copies for the plots, the stems stay in the backend for synth
+        drums_stft, bass_stft, acc_stft, voc_stft = [dsp.to_numpy(x) for x in (drums_stft, bass_stft, acc_stft, voc_stft)]
+        plot_drums, plot_bass, plot_others, plot_vocals = [dsp.to_numpy(x) for x in (out_drums, out_bass, out_others, out_vocals)]
+
         plt.figure(1)
         plt.suptitle(file_name[:-9])
         ax1 = plt.subplot(411)
         plt.imshow(np.log(drums_stft[0].T),aspect = 'auto', origin = 'lower')
         ax1.set_title("Drums Left Channel Ground Truth", fontsize = 10)
         ax2 = plt.subplot(412, sharex = ax1, sharey = ax1)
-        plt.imshow(np.log(out_drums[0].T),aspect = 'auto', origin = 'lower')
+        plt.imshow(np.log(plot_drums[0].T),aspect = 'auto', origin = 'lower')
         ax2.set_title("Drums Left Channel Network Output", fontsize = 10)
         ax3 = plt.subplot(413, sharex = ax1, sharey = ax1)
         plt.imshow(np.log(drums_stft[1].T),aspect = 'auto', origin = 'lower')
         ax3.set_title("Drums Right Channel Ground Truth", fontsize = 10)
         ax4 = plt.subplot(414, sharex = ax1, sharey = ax1)
-        plt.imshow(np.log(out_drums[1].T),aspect = 'auto', origin = 'lower')
+        plt.imshow(np.log(plot_drums[1].T),aspect = 'auto', origin = 'lower')
         ax4.set_title("Drums Right Channel Network Output", fontsize = 10)
 
         plt.figure(2)
@@ -490,13 +538,13 @@ def evalNetwork(file_name, load_name='model_e4000_b50_bs5_1709', plot = False, s
         plt.imshow(np.log(voc_stft[0].T),aspect = 'auto', origin = 'lower')
         ax1.set_title("Vocals Left Channel Ground Truth", fontsize = 10)
         ax2 = plt.subplot(412, sharex = ax1, sharey = ax1)
-        plt.imshow(np.log(out_vocals[0].T),aspect = 'auto', origin = 'lower')
+        plt.imshow(np.log(plot_vocals[0].T),aspect = 'auto', origin = 'lower')
         ax2.set_title("Vocals Left Channel Network Output", fontsize = 10)
         ax3 = plt.subplot(413, sharex = ax1, sharey = ax1)
         plt.imshow(np.log(voc_stft[1].T),aspect = 'auto', origin = 'lower')
         ax3.set_title("Vocals Right Channel Ground Truth", fontsize = 10)
         ax4 = plt.subplot(414, sharex = ax1, sharey = ax1)
-        plt.imshow(np.log(out_vocals[1].T),aspect = 'auto', origin = 'lower')
+        plt.imshow(np.log(plot_vocals[1].T),aspect = 'auto', origin = 'lower')
         ax4.set_title("Vocals Right Channel Network Output", fontsize = 10)
 
 
@@ -506,13 +554,13 @@ def evalNetwork(file_name, load_name='model_e4000_b50_bs5_1709', plot = False, s
         plt.imshow(np.log(bass_stft[0].T),aspect = 'auto', origin = 'lower')
         ax1.set_title("Bass Left Channel Ground Truth", fontsize = 10)
         ax2 = plt.subplot(412, sharex = ax1, sharey = ax1)
-        plt.imshow(np.log(out_bass[0].T),aspect = 'auto', origin = 'lower')
+        plt.imshow(np.log(plot_bass[0].T),aspect = 'auto', origin = 'lower')
         ax2.set_title("Bass Left Channel Network Output", fontsize = 10)
         ax3 = plt.subplot(413, sharex = ax1, sharey = ax1)
         plt.imshow(np.log(bass_stft[1].T),aspect = 'auto', origin = 'lower')
         ax3.set_title("Bass Right Channel Ground Truth", fontsize = 10)
         ax4 = plt.subplot(414, sharex = ax1, sharey = ax1)
-        plt.imshow(np.log(out_bass[1].T),aspect = 'auto', origin = 'lower')
+        plt.imshow(np.log(plot_bass[1].T),aspect = 'auto', origin = 'lower')
         ax4.set_title("Bass Right Channel Network Output", fontsize = 10)
 
         plt.figure(4)
@@ -521,13 +569,13 @@ def evalNetwork(file_name, load_name='model_e4000_b50_bs5_1709', plot = False, s
         plt.imshow(np.log(acc_stft[0].T),aspect = 'auto', origin = 'lower')
         ax1.set_title("Others Left Channel Ground Truth", fontsize = 10)
         ax2 = plt.subplot(412, sharex = ax1, sharey = ax1)
-        plt.imshow(np.log(out_others[0].T),aspect = 'auto', origin = 'lower')
+        plt.imshow(np.log(plot_others[0].T),aspect = 'auto', origin = 'lower')
         ax2.set_title("Others Left Channel Network Output", fontsize = 10)
         ax3 = plt.subplot(413, sharex = ax1, sharey = ax1)
         plt.imshow(np.log(acc_stft[1].T),aspect = 'auto', origin = 'lower')
         ax3.set_title("Others Right Channel Ground Truth", fontsize = 10)
         ax4 = plt.subplot(414, sharex = ax1, sharey = ax1)
-        plt.imshow(np.log(out_others[1].T),aspect = 'auto', origin = 'lower')
+        plt.imshow(np.log(plot_others[1].T),aspect = 'auto', origin = 'lower')
         ax4.set_title("Others Right Channel Network Output", fontsize = 10)
 
 
@@ -535,10 +583,9 @@ def evalNetwork(file_name, load_name='model_e4000_b50_bs5_1709', plot = False, s
 
     if synth:
         # import pdb;pdb.set_trace()
-        utils.inverse_stft_write(out_drums[:,:mix_phase.shape[1],:],mix_phase,config.out_dir+file_name+"_drums.wav")
-        utils.inverse_stft_write(out_bass[:,:mix_phase.shape[1],:],mix_phase,config.out_dir+file_name+"_bass.wav")
-        utils.inverse_stft_write(out_vocals[:,:mix_phase.shape[1],:],mix_phase,config.out_dir+file_name+"_vocals.wav")
-        utils.inverse_stft_write(out_others[:,:mix_phase.shape[1],:],mix_phase,config.out_dir+file_name+"_others.wav")
+        out_stems = [out_drums, out_bass, out_vocals, out_others]
+        dsp.write_stems([out[:,:mix_phase.shape[1],:] for out in out_stems],mix_phase,
+                        [config.out_dir+file_name+"_"+stem+".wav" for stem in ("drums", "bass", "vocals", "others")])
 
 
 def plot_loss():
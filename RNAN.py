@@ -8,7 +8,7 @@ import datetime
 import sys
 import time
 from PytorchConvSep import AutoEncoder#, loss_calc
-from data_pipeline import data_gen
+from data_pipeline import data_gen, BatchLoader, loader_pool_stats
 import config
 import utils
 import h5py
@@ -66,14 +66,19 @@ def trainNetwork(dataset='model6'):
 
     eval_evol = []
     
+    train_loader = BatchLoader()
+
+    val_loader = BatchLoader(mode= "Val")
     
     for epoch in range(config.dn_num_epochs):
     
         start_time = time.time()
         
-        train_gen = data_gen()
+        train_gen = train_loader
+
+        val_gen = val_loader
 
-        val_gen = data_gen(mode= "Val")
+        wait_time = train_loader.wait_time + val_loader.wait_time
         
         optimizer.zero_grad()
         train_loss = 0
@@ -185,12 +190,17 @@ def trainNetwork(dataset='model6'):
         if (epoch+1)%config.print_every == 0:
             print('epoch %d/%d, took %.2f seconds, epoch total loss: %.7f' % (epoch+1, config.num_epochs, duration, train_loss/(config.batches_per_epoch_train*count*config.max_phr_len*513)))
             print('                                  validation total loss: %.7f' % ( eval_loss / (config.batches_per_epoch_train*count*config.max_phr_len*513)))
+            print('                                  waited for data: %.2f seconds' % (train_loader.wait_time + val_loader.wait_time - wait_time))
+            print('                                  hdf5 handles: %(hits)d hits, %(misses)d misses, %(evictions)d evictions' % loader_pool_stats(train_loader, val_loader))
             
         if (epoch+1)%config.save_every  == 0:
             torch.save(denoiser_vocals.state_dict(), config.dn_log_dir+save_name+'_'+str(epoch)+'.pt')
             np.save(config.dn_log_dir+'dn_train_loss',np.array(train_evol))
             np.save(config.dn_log_dir+'dn_val_loss',np.array(eval_evol))
 
+    train_loader.close()
+    val_loader.close()
+
 
 def evalNetwork(file_name='Al James - Schoolboy Facination.stem.mp4', load_name_sep = 'model6',load_name_dn = 'dn_model_719',  plot = True, synth = False):
 
@@ -202,8 +212,10 @@ def evalNetwork(file_name='Al James - Schoolboy Facination.stem.mp4', load_name_
 
     stat_file = h5py.File(config.stat_dir+'stats.hdf5', mode='r')
 
-    max_feat = np.array(stat_file["feats_maximus"])
-    min_feat = np.array(stat_file["feats_minimus"])
+    dsp = utils.get_dsp_backend()
+
+    max_feat = dsp.asarray(np.array(stat_file["feats_maximus"]))
+    min_feat = dsp.asarray(np.array(stat_file["feats_minimus"]))
     max_feat_tars = max_feat[:8,:].reshape(8,1,513)
     min_feat_tars = min_feat[:8,:].reshape(8,1,513)
     max_feat_ins = max_feat[-2:,:].reshape(2,1,513)
@@ -211,37 +223,23 @@ def evalNetwork(file_name='Al James - Schoolboy Facination.stem.mp4', load_name_
 
 
 
-    audio,fs = stempeg.read_stems(os.path.join(config.wav_dir_test,file_name), stem_id=[0,1,2,3,4])
-    
-    mixture = audio[0]
-    drums = audio[1]
-    bass = audio[2]
-    acc = audio[3]
-    vocals = audio[4]
+    mixture,fs = utils.read_stems(os.path.join(config.wav_dir_test,file_name),stem_id=0)
 
-    mix_stft, mix_phase = utils.stft_stereo(mixture,phase=True)
+    mix_stft, mix_phase = dsp.stft_stereo(mixture,phase=True)
 
     mix_stft = (mix_stft-min_feat_ins)/(max_feat_ins-min_feat_ins)
 
-    drums_stft = utils.stft_stereo(drums)
-
-    bass_stft = utils.stft_stereo(bass)
-    
-    acc_stft = utils.stft_stereo(acc)
-
-    voc_stft = utils.stft_stereo(vocals)
-
-    in_batches, nchunks_in = utils.generate_overlapadd(mix_stft)
+    in_batches, nchunks_in = dsp.generate_overlapadd(mix_stft)
 
     out_batches = []
 
     for in_batch in in_batches:
         # import pdb;pdb.set_trace()
-        in_batch = Variable(torch.FloatTensor(in_batch)).cuda()
+        in_batch = Variable(dsp.to_model(in_batch)).cuda()
         out_batch = autoencoder_audio(in_batch)
-        out_batches.append(np.array(out_batch.data.cpu().numpy()))
+        out_batches.append(dsp.from_model(out_batch))
 
-    out_batches = np.array(out_batches)
+    out_batches = dsp.stack(out_batches)
     
     vocals = out_batches[:,:,:2,:,:]
 
@@ -279,11 +277,11 @@ def evalNetwork(file_name='Al James - Schoolboy Facination.stem.mp4', load_name_
     out_batches_vocals = []
     #print (np.array(out_vocals_2).shape)
     for vocal_batch in range(vocals.shape[0]):
-        vocal_batch =  Variable(torch.FloatTensor(out_vocals_2[vocal_batch,:,:])).cuda()
+        vocal_batch =  Variable(dsp.to_model(out_vocals_2[vocal_batch,:,:])).cuda()
         out_batch = denoiser(vocal_batch)
-        out_batches_vocals.append(np.array(out_batch.data.cpu().numpy()))
-    out_vocals_2 = utils.overlapadd(out_vocals_2, nchunks_in)
-    out_vocals = utils.overlapadd(np.array(out_batches_vocals), nchunks_in) 
+        out_batches_vocals.append(dsp.from_model(out_batch))
+    out_vocals_2 = dsp.to_numpy(dsp.overlapadd(out_vocals_2, nchunks_in))
+    out_vocals = dsp.to_numpy(dsp.overlapadd(dsp.stack(out_batches_vocals), nchunks_in)) 
     #out_vocals = out_vocals*(max_feat_tars[:2,:,:]-min_feat_tars[:2,:,:])+min_feat_tars[:2,:,:]
     print (out_vocals.shape)
     if plot:
@@ -0,0 +1,91 @@
+"""
+Benchmarks the HDF5 layouts prep_data.create_feature_datasets can write.
+
+A converted track is copied into every layout (including the reduced
+precision storages, see utils.encode_magnitudes), and for each one the size
+on disk and the mean latency of reading and decoding a random
+config.max_phr_len frame window from mix_stft and tar_stft (as data_gen
+does) are reported. Reads go
+through the page cache after the first ones, so run it on the storage used
+for training, with a track larger than the cache, to see the real I/O cost.
+
+    python bench_hdf5.py [track.hdf5] [number of reads]
+"""
+
+import os
+import shutil
+import sys
+import time
+import tempfile
+import numpy as np
+import h5py
+
+import config
+import data_pipeline
+import prep_data
+import utils
+
+
+# name, chunk_frames, compression, shuffle, storage
+layouts = [
+    ("contiguous", None, None, False, "float32"),
+    ("chunks 32", 32, None, False, "float32"),
+    ("chunks 64", 64, None, False, "float32"),
+    ("chunks 32 lzf", 32, "lzf", False, "float32"),
+    ("chunks 32 shuffle lzf", 32, "lzf", True, "float32"),
+    ("chunks 64 shuffle lzf", 64, "lzf", True, "float32"),
+    ("chunks 32 shuffle gzip", 32, "gzip", True, "float32"),
+    ("chunks 32 float16", 32, None, False, "float16"),
+    ("chunks 32 log_uint16", 32, None, False, "log_uint16"),
+]
+
+def copy_track(in_file, out_file, chunk_frames, compression, shuffle, storage="float32", block_frames=1024):
+    with h5py.File(in_file, "r") as src, h5py.File(out_file, "w") as dst:
+        n_frames = src["mix_stft"].shape[1]
+        prep_data.create_feature_datasets(dst, n_frames, chunk_frames, compression, shuffle, storage)
+        for name in ("mix_stft", "tar_stft"):
+            prep_data.copy_frames(src[name], dst[name], storage, block_frames=block_frames)
+
+def read_latency(file_name, reads, seed=0):
+    with h5py.File(file_name, "r") as hdf5_file:
+        mix_stft = utils.StoredFeature(hdf5_file["mix_stft"])
+        tar_stft = utils.StoredFeature(hdf5_file["tar_stft"])
+        indices = np.random.RandomState(seed).randint(0, mix_stft.shape[1]-config.max_phr_len, reads)
+        start_time = time.time()
+        for index in indices:
+            mix_stft[:, index:index+config.max_phr_len, :]
+            tar_stft[:, index:index+config.max_phr_len, :]
+    return (time.time()-start_time)/reads
+
+def synthetic_track(out_file, seconds=60):
+    audio = np.random.RandomState(0).randn(5, 44100*seconds, 2)*0.1
+    with h5py.File(out_file, "w") as hdf5_file:
+        prep_data.create_feature_datasets(hdf5_file, utils.stft_frames(audio.shape[1]), chunk_frames=None, storage="float32")
+        utils.stft_stems(audio, hdf5_file["mix_stft"], hdf5_file["tar_stft"])
+
+def main(in_file=None, reads=1000):
+    tmp_dir = tempfile.mkdtemp()
+
+    if in_file is None:
+        tracks = data_pipeline.feature_files(config.dir_hdf5) if os.path.isdir(config.dir_hdf5) else []
+        if tracks:
+            in_file = os.path.join(config.dir_hdf5, tracks[0])
+        else:
+            print("No converted track found, using a synthetic one")
+            in_file = os.path.join(tmp_dir, "synthetic.hdf5")
+            synthetic_track(in_file)
+
+    print("%-24s %12s %16s" % ("layout", "size (MB)", "read (ms/window)"))
+    for name, chunk_frames, compression, shuffle, storage in layouts:
+        out_file = os.path.join(tmp_dir, name.replace(" ", "_")+".hdf5")
+        copy_track(in_file, out_file, chunk_frames, compression, shuffle, storage)
+        size = os.path.getsize(out_file)/2.0**20
+        latency = read_latency(out_file, reads)*1000
+        print("%-24s %12.1f %16.3f" % (name, size, latency))
+        os.remove(out_file)
+
+    shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else None,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
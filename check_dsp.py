@@ -0,0 +1,147 @@
+"""
+Checks the DSP functions of utils against the float64 path and against the
+original per-frame implementations, which are kept below as references:
+
+- float64 stft, overlapadd and generate_overlapadd are bit-identical to
+  the original loops, and float64 istft agrees with its loop to ~1e-15;
+- float32 spectra and resynthesised audio are within the tolerance
+  documented in utils.get_dtype of the float64 ones (relative to the
+  peak magnitude), the padded tail istft returns past the end of the
+  signal within the looser one documented there;
+- the streaming versions (stft_stream, istft_stream,
+  generate_overlapadd_stream, overlapadd_stream) give exactly the
+  results of the whole-signal functions.
+
+Run it after changing the DSP code; it exits with status 1 if a check fails.
+
+    python check_dsp.py [seconds of random stereo signal] [seed]
+"""
+
+import sys
+import numpy as np
+
+import config
+import utils
+
+
+def loop_stft(data, window=np.hanning(1024), hopsize=256.0, nfft=1024.0):
+    lengthWindow = window.size
+    numberFrames = np.ceil(data.size / np.double(hopsize)) + 2
+    newLengthData = (numberFrames-1) * hopsize + lengthWindow
+    data = np.concatenate((np.zeros(int(lengthWindow/2)), data))
+    data = np.concatenate((data, np.zeros(int(newLengthData - data.size))))
+    STFT = np.zeros([int(numberFrames), int(nfft/2+1)], dtype=complex)
+    for n in np.arange(numberFrames):
+        beginFrame = n*hopsize
+        frameToProcess = window*data[int(beginFrame):int(beginFrame+lengthWindow)]
+        STFT[int(n),:] = np.fft.rfft(frameToProcess, np.int32(nfft), norm="ortho")
+    return STFT
+
+def loop_istft(mag, phase, window=np.hanning(1024), hopsize=256.0, nfft=1024.0):
+    X = (mag * np.exp(1j*phase)).T
+    lengthWindow = window.size
+    numberFrames = X.shape[1]
+    lengthData = int(hopsize*(numberFrames-1) + lengthWindow)
+    normalisationSeq = np.zeros(lengthData)
+    data = np.zeros(lengthData)
+    for n in np.arange(numberFrames):
+        beginFrame = int(n * hopsize)
+        endFrame = beginFrame + lengthWindow
+        frameTMP = np.fft.irfft(X[:,n], np.int32(nfft), norm='ortho')[:lengthWindow]
+        normalisationSeq[beginFrame:endFrame] = normalisationSeq[beginFrame:endFrame] + window*window
+        data[beginFrame:endFrame] = data[beginFrame:endFrame] + window*frameTMP
+    data = data[int(lengthWindow/2.0):]
+    normalisationSeq = normalisationSeq[int(lengthWindow/2.0):]
+    normalisationSeq[normalisationSeq==0] = 1.
+    return data / normalisationSeq
+
+def loop_generate_overlapadd(allmix, time_context=config.max_phr_len, overlap=config.max_phr_len/2,
+                             batch_size=config.batch_size):
+    chunks = []
+    start = 0
+    while (start + time_context) < allmix.shape[1]:
+        chunks.append(allmix[:,int(start):int(start+time_context),:])
+        start = start - overlap + time_context
+    return chunks
+
+def loop_overlapadd(fbatch, nchunks, overlap=int(config.max_phr_len/2)):
+    input_size = fbatch.shape[-1]
+    time_context = fbatch.shape[-2]
+    batch_size = fbatch.shape[1]
+    window = np.linspace(0., 1.0, num=overlap)
+    window = np.repeat(np.expand_dims(np.concatenate((window,window[::-1])), axis=1), input_size, axis=1)
+    sep = np.zeros((2,int(nchunks*(time_context-overlap)+time_context),input_size))
+    start = 0
+    for i in range(nchunks):
+        sa = fbatch[int(i/batch_size),int(i%batch_size),:,:,:]
+        if start == 0:
+            sep[:,0:time_context,:] = sa
+        else:
+            sep[:,int(start+overlap):int(start+time_context),:] = sa[:,overlap:time_context]
+            sep[:,start:int(start+overlap),:] = window[overlap:]*sep[:,start:int(start+overlap),:] + window[:overlap]*sa[:,:overlap]
+        start = int(start - overlap + time_context)
+    return sep
+
+def max_error(a, b, scale=1.0):
+    # in double precision, complex if either is
+    a, b = np.asarray(a), np.asarray(b)
+    dtype = np.result_type(a, b, np.float64)
+    return float(np.max(np.abs(a.astype(dtype) - b.astype(dtype))))/scale
+
+def blocks_of(data, size, axis=-1):
+    return (np.take(data, range(start, min(start+size, data.shape[axis])), axis=axis)
+            for start in range(0, data.shape[axis], size))
+
+def main(seconds=3.0, seed=0):
+    rng = np.random.RandomState(seed)
+    audio = rng.randn(int(seconds*config.fs), 2)*0.1
+    length = audio.shape[0]
+    results = []
+
+    def check(name, error, tolerance):
+        results.append((name, error, tolerance, error <= tolerance))
+
+    # the original implementations, in double precision
+    X64 = utils.stft(audio.T, dtype=np.float64)
+    check("stft float64 vs loop", max_error(X64, [loop_stft(channel) for channel in audio.T]), 0.0)
+    mag, phase = np.abs(X64), np.angle(X64)
+    audio64 = utils.istft(mag, phase, dtype=np.float64)
+    check("istft float64 vs loop", max_error(audio64, [loop_istft(m, p) for m, p in zip(mag, phase)]), 1e-13)
+
+    # the float32 policy
+    X32 = utils.stft(audio.T, dtype=np.float32)
+    check("stft float32 vs float64", max_error(X32, X64, np.abs(X64).max()), 1e-6)
+    audio32 = utils.istft(mag, phase, dtype=np.float32)
+    peak = np.abs(audio64).max()
+    check("istft float32 vs float64", max_error(audio32[:, :length], audio64[:, :length], peak), 1e-6)
+    check("istft float32 tail vs float64", max_error(audio32[:, length:], audio64[:, length:], peak), 1e-3)
+
+    # chunking for the model
+    feats = mag.astype(np.float64)
+    fbatch, nchunks = utils.generate_overlapadd(feats, dtype=np.float64)
+    chunks = fbatch.reshape((-1,) + fbatch.shape[2:])[:nchunks]
+    check("generate_overlapadd float64 vs loop", max_error(chunks, loop_generate_overlapadd(feats)), 0.0)
+    sep = utils.overlapadd(fbatch, nchunks, dtype=np.float64)
+    check("overlapadd float64 vs loop", max_error(sep, loop_overlapadd(np.array(fbatch), nchunks)), 0.0)
+
+    # streaming
+    stream = np.concatenate(list(utils.stft_stream(blocks_of(audio.T, 10000), dtype=np.float32)), axis=-2)
+    check("stft_stream vs stft", max_error(stream, X32), 0.0)
+    fbatch32, nchunks = utils.generate_overlapadd(np.abs(X32))
+    batches = list(utils.generate_overlapadd_stream(blocks_of(np.abs(X32), 37, axis=1)))
+    check("generate_overlapadd_stream vs generate_overlapadd",
+          max_error(np.array([batch for batch, n in batches]), fbatch32), 0.0)
+    stream = np.concatenate(list(utils.overlapadd_stream(batches)), axis=-2)
+    check("overlapadd_stream vs overlapadd", max_error(stream, utils.overlapadd(fbatch32, nchunks)), 0.0)
+    stream = np.concatenate(list(utils.istft_stream(zip(blocks_of(mag, 100, axis=1), blocks_of(phase, 100, axis=1)))), axis=-1)
+    check("istft_stream vs istft", max_error(stream, audio32), 0.0)
+
+    print("%-52s %12s %10s" % ("check", "error", "tolerance"))
+    for name, error, tolerance, ok in results:
+        print("%-52s %12.3g %10.3g %s" % (name, error, tolerance, "ok" if ok else "FAILED"))
+    return all(ok for name, error, tolerance, ok in results)
+
+if __name__ == '__main__':
+    ok = main(float(sys.argv[1]) if len(sys.argv) > 1 else 3.0,
+              int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    sys.exit(0 if ok else 1)
@@ -17,11 +17,33 @@ data_aug = False
 dir_hdf5 = '../../data_h5py/'
 dir_hdf5_test = '../../data_h5py_test/'
 stat_dir = './stats/'
+# 16 bit PCM of the decoded stem.mp4 audio, never cleaned up, see
+# utils.read_stems; None to always decode
+audio_cache_dir = './audio_cache/'
+# ffmpeg processes decoding the stems of a track at once, see utils.decode_stems
+decode_threads = 5
 h5py_file_train = './data_h5py/train.hdf5'
 h5py_file_val = './data_h5py/val.hdf5'
+npy_dir_train = './data_npy/train/'
+npy_dir_val = './data_npy/val/'
+# 'tracks' (one file per track in dir_hdf5), 'consolidated' (h5py_file_train/val)
+# or 'npy' (npy_dir_train/val), see data_pipeline.open_dataset
+dataset_format = 'tracks'
 val_dir = './val_dir/'
 
 in_mode = 'mix'
+
+# 'numpy' or 'torch', see utils.get_dsp_backend
+dsp_backend = 'numpy'
+dsp_device = 'cpu'
+# 'float32' or 'float64', see utils.get_dtype
+dsp_dtype = 'float32'
+# frames decoded, separated and resynthesised per block when evalNetwork
+# only writes the stems with the numpy backend (see
+# PytorchConvSep.separate_stream), and stems written at once by
+# utils.write_stems
+synth_block_frames = 4096
+synth_threads = 4
 norm_mode_out = "max_min"
 norm_mode_in = "max_min"
 
@@ -35,6 +57,21 @@ features = 513
 
 split = 0.9
 
+# processes converting tracks in prep_data
+prep_workers = 4
+# hdf5 feature layout, see prep_data.create_feature_datasets and bench_hdf5.py
+hdf5_chunk_frames = 32
+hdf5_compression = None
+hdf5_shuffle = False
+# hdf5 files data_gen keeps open per process, see data_pipeline.HandlePool;
+# each holds a chunk cache of up to 1 MB per feature dataset. Keep it above
+# the tracks of both splits (150 for MUSDB): the sampler goes through every
+# track each epoch, which an LRU pool smaller than that keeps reopening
+hdf5_pool_size = 256
+# 'float32', 'float16' or 'log_uint16' magnitudes, see utils.encode_magnitudes
+# and prep_data.storage_error
+feature_storage = 'float32'
+
 # Hyperparameters
 num_epochs = 8000
 batches_per_epoch_train = 50
@@ -42,6 +79,32 @@ batches_per_epoch_val = 50
 batch_size = 5
 samples_per_file = 1
 max_phr_len = 30
+# None, or 'float32'/'float16' to load the training features in shared
+# memory, up to dataset_cache_bytes for the Train and Val splits together
+# (the one loaded first, Train when training, is served first), see
+# data_pipeline.memory_dataset
+dataset_cache = None
+dataset_cache_bytes = 32*2**30
+# processes and shared batch buffers (at least 2) of
+# data_pipeline.BatchLoader; with 0 workers data_gen runs in the training
+# process
+loader_workers = 4
+loader_depth = 8
+# 'epoch' draws the samples of data_gen from sampler_seed and the epoch,
+# every track once before any is drawn again, split between the loader
+# workers and the sampler_num_shards training processes (this one being
+# sampler_shard); 'legacy' draws them from np.random, see
+# data_pipeline.EpochSampler
+sampler_mode = 'epoch'
+sampler_seed = 0
+sampler_shard = 0
+sampler_num_shards = 1
+# data_gen only draws windows whose mean mixture magnitude over the first
+# activity_bins bins is above activity_threshold, see data_pipeline.ActivityIndex
+activity_bins = 425
+activity_threshold = 0.02
+# draw the active windows with probability proportional to their activity
+activity_weighted = False
 input_features = 513
 lstm_size = 128
 output_features = 66
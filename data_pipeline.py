@@ -1,166 +1,940 @@
 import numpy as np
 import os
+import json
 import time
+import collections
+import multiprocessing
+import queue
+import traceback
 import h5py
 
 import config
-
-def data_gen(mode = 'Train', data_aug = False):
-    stat_file = h5py.File(config.stat_dir+'stats.hdf5', mode='r')
-    #import pdb;pdb.set_trace()
-    max_feat = np.array(stat_file["feats_maximus"])
-    min_feat = np.array(stat_file["feats_minimus"])
-    
-    max_feat_tars = max_feat[:8,:].reshape(1,8,1,513)
+import utils
+
+class HandlePool(object):
+    """
+    Read-only h5py handles kept open by file name, so a file is only
+    opened (and its superblock and metadata read) on the first access,
+    not for every sample. At most size handles stay open, the least
+    recently used ones are closed first, but never while acquired. hits,
+    misses and evictions count what acquire did.
+    """
+    def __init__(self, size=config.hdf5_pool_size):
+        self.size = size
+        self.handles = collections.OrderedDict()
+        self.users = collections.Counter()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, file_name):
+        """
+        The open handle of file_name, to be given back with release.
+        """
+        if file_name in self.handles:
+            self.hits += 1
+            self.handles.move_to_end(file_name)
+        else:
+            self.misses += 1
+            self.handles[file_name] = h5py.File(file_name, "r")
+        self.users[file_name] += 1
+        self._evict()
+        return self.handles[file_name]
+
+    def release(self, file_name):
+        self.users[file_name] -= 1
+        if self.users[file_name] <= 0:
+            del self.users[file_name]
+        self._evict()
+
+    def _evict(self):
+        for file_name in list(self.handles):
+            if len(self.handles) <= self.size:
+                break
+            if not self.users[file_name]:
+                self.handles.pop(file_name).close()
+                self.evictions += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "open": len(self.handles)}
+
+    def close(self):
+        for hdf5_file in self.handles.values():
+            hdf5_file.close()
+        self.handles.clear()
+        self.users.clear()
+
+_handle_pools = {}
+
+def handle_pool():
+    """
+    The HandlePool of this process, shared by every dataset it opens, so
+    handles are reused by the train and val generators and across epochs.
+    Loader processes get their own, h5py handles can't be shared with a
+    forked process.
+    """
+    pid = os.getpid()
+    if pid not in _handle_pools:
+        _handle_pools[pid] = HandlePool()
+    return _handle_pools[pid]
+
+def feature_files(in_dir):
+    """
+    The names of the per-track feature files in in_dir, sorted: its .hdf5
+    files, without the ._ resource forks macOS writes next to them.
+    """
+    return sorted(x for x in os.listdir(in_dir) if x.endswith('.hdf5') and not x.startswith('._'))
+
+class TrackDataset(object):
+    """
+    The per-track HDF5 files prep_data writes in a directory, opened
+    through the handle_pool.
+    """
+    def __init__(self, in_dir):
+        self.in_dir = in_dir
+        self.names = feature_files(in_dir)
+
+    def __len__(self):
+        return len(self.names)
+
+    def open_track(self, index):
+        return TrackFile(self.in_dir+self.names[index])
+
+    def activity(self, index):
+        track = self.open_track(index)
+        try:
+            if "activity" in track.hdf5_file:
+                return track.hdf5_file["activity"][:]
+        finally:
+            track.close()
+
+    def close(self):
+        pass
+
+class TrackFile(object):
+    """
+    A per-track feature file, acquired from the handle_pool until close:
+    track["mix_stft"] slices are decoded to float32 whatever the storage
+    of the features, see utils.StoredFeature.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.hdf5_file = handle_pool().acquire(file_name)
+
+    def __getitem__(self, name):
+        return utils.StoredFeature(self.hdf5_file[name])
+
+    def close(self):
+        if self.hdf5_file is not None:
+            handle_pool().release(self.file_name)
+            self.hdf5_file = None
+
+class ConsolidatedDataset(object):
+    """
+    A split stored in a single HDF5 file by prep_data.consolidate: mix_stft
+    and tar_stft hold all the tracks one after the other along the frames
+    axis, and the offsets, lengths and names datasets index them. The file
+    stays open in the handle_pool, so reading a window from a track is a
+    single slice.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.hdf5_file = handle_pool().acquire(file_name)
+        self.names = [name.decode('utf-8') if isinstance(name, bytes) else name
+                      for name in self.hdf5_file["names"][:]]
+        self.offsets = np.array(self.hdf5_file["offsets"])
+        self.lengths = np.array(self.hdf5_file["lengths"])
+        self.feats = dict((name, utils.StoredFeature(self.hdf5_file[name])) for name in ("mix_stft", "tar_stft"))
+
+    def __len__(self):
+        return len(self.names)
+
+    def open_track(self, index):
+        return ConsolidatedTrack(self, index)
+
+    def activity(self, index):
+        if "activity" in self.hdf5_file:
+            return self.hdf5_file["activity"][self.offsets[index]:self.offsets[index]+self.lengths[index]]
+
+    def close(self):
+        handle_pool().release(self.file_name)
+
+class ConsolidatedTrack(object):
+    """
+    One track of a ConsolidatedDataset, used like the h5py.File of a track:
+    track["mix_stft"][:, index:index+30, :] reads frames of that track only.
+    """
+    def __init__(self, dataset, index):
+        self.dataset = dataset
+        self.offset = dataset.offsets[index]
+        self.length = dataset.lengths[index]
+
+    def __getitem__(self, name):
+        return FrameWindow(self.dataset.feats[name], self.offset, self.length)
+
+    def close(self):
+        pass
+
+class FrameWindow(object):
+    """
+    The frames [offset, offset+length) of a (channels, frames, features)
+    array, sliced with frame indices relative to offset.
+    """
+    def __init__(self, feat, offset, length):
+        self.feat = feat
+        self.offset = offset
+        self.length = length
+        self.shape = (feat.shape[0], length, feat.shape[2])
+
+    def _key(self, key):
+        channels, frames, features = key
+        start, stop, step = frames.indices(self.length)
+        assert step == 1
+        return channels, slice(self.offset+start, self.offset+stop), features
+
+    def __getitem__(self, key):
+        return self.feat[self._key(key)]
+
+    def read_into(self, out, key):
+        self.feat.read_into(out, self._key(key))
+
+class NpyDataset(object):
+    """
+    A split exported by prep_data.export_npy: one .npy shard per track and
+    feature, listed in index.json. The shards are memory-mapped, so
+    windows of float32 shards are zero-copy views into the page cache, and
+    only copied once, into the batch (float16 and log_uint16 ones are
+    decoded on the way). Unlike h5py, reads don't go through a global lock, so
+    loader processes don't serialise on them.
+    """
+    def __init__(self, in_dir):
+        self.in_dir = in_dir
+        with open(os.path.join(in_dir, 'index.json')) as index_file:
+            self.index = json.load(index_file)["tracks"]
+        self.names = [track["name"] for track in self.index]
+        self.lengths = np.array([track["length"] for track in self.index])
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def open_track(self, index):
+        if index not in self.shards:
+            self.shards[index] = NpyTrack(dict(
+                (feat, utils.StoredFeature(np.load(os.path.join(self.in_dir, self.index[index][feat]), mmap_mode='r'),
+                                           self.index[index].get("storage", "float32")))
+                for feat in ("mix_stft", "tar_stft")))
+        return self.shards[index]
+
+    def activity(self, index):
+        if "activity" in self.index[index]:
+            return np.load(os.path.join(self.in_dir, self.index[index]["activity"]))
+
+    def close(self):
+        self.shards = {}
+
+class NpyTrack(dict):
+    """
+    The memory-mapped features of one track of an NpyDataset.
+    """
+    def close(self):
+        pass
+
+class ActivityIndex(object):
+    """
+    The windows of config.max_phr_len frames data_gen can draw from the
+    tracks of dataset: those whose activity, the mean of the per-frame
+    activity prep_data stores (see prep_data.frame_activity), is above
+    threshold. Sampling from them directly replaces reading random windows
+    until one is active. With weighted, windows are drawn with probability
+    proportional to their activity.
+    """
+    def __init__(self, dataset, threshold=config.activity_threshold, weighted=config.activity_weighted):
+        self.dataset = dataset
+        self.threshold = threshold
+        self.weighted = weighted
+        self.windows = {}
+
+    def active_windows(self, index):
+        """
+        starts, probabilities = active_windows(index)
+
+        The start frames of the active windows of track index, in the same
+        range data_gen draws from, and the probability of drawing each one
+        (None for uniform). starts is None if the track has no stored
+        activity, and empty if it has no active window.
+        """
+        if index not in self.windows:
+            activity = self.dataset.activity(index)
+            if activity is None:
+                self.windows[index] = None, None
+            else:
+                length = config.max_phr_len
+                cumsum = np.concatenate(([0.], np.cumsum(activity, dtype=np.float64)))
+                means = (cumsum[length:-1] - cumsum[:-length-1])/length
+                starts = np.flatnonzero(means > self.threshold)
+                probabilities = None
+                if self.weighted and len(starts) > 0:
+                    probabilities = means[starts]/means[starts].sum()
+                self.windows[index] = starts, probabilities
+        return self.windows[index]
+
+    def sample(self, index, rng=np.random):
+        """
+        A random active window start of track index, drawn with rng, or
+        None if the track has no stored activity. Raises ValueError if it
+        has no active window (see EpochSampler.usable_tracks).
+        """
+        starts, probabilities = self.active_windows(index)
+        if starts is None:
+            return None
+        if len(starts) == 0:
+            raise ValueError("Track %d has no active window" % index)
+        return rng.choice(starts, p=probabilities)
+
+class EpochSampler(object):
+    """
+    Plans the (track, window) samples data_gen reads, batch by batch.
+
+    In mode 'epoch' the plan only depends on the tracks (in the order of
+    their names), seed, epoch, the shard, num_shards and the num_batches
+    of the epoch: tracks are taken in turn from an endless sequence of
+    random permutations of all the tracks, so every track is drawn once
+    before any is drawn again, and the windows are drawn from the
+    ActivityIndex with a generator seeded from (seed, epoch, batch,
+    shard). Each batch of the epoch takes the next num_shards slices of
+    the sequence, one per shard, so shards (loader workers and training
+    processes) never draw the same track slot and together draw
+    num_shards times the batches of one. Only the usable_tracks are
+    drawn. num_shards and num_batches both change with
+    config.loader_workers, see BatchLoader. In mode 'legacy' tracks and
+    windows are drawn from np.random, as data_gen did before.
+    """
+    def __init__(self, dataset, epoch=0, shard=0, num_shards=1,
+                 seed=config.sampler_seed, mode=config.sampler_mode):
+        if mode not in ('epoch', 'legacy'):
+            raise ValueError("Unknown sampler mode %r" % mode)
+        self.dataset = dataset
+        self.seed = seed
+        self.mode = mode
+        self.activity = ActivityIndex(dataset, config.activity_threshold, config.activity_weighted)
+        self.lengths = {}
+        self.permutations = {}
+        self.usable = None
+        self.set_epoch(epoch, shard, num_shards)
+
+    def set_epoch(self, epoch, shard=None, num_shards=None):
+        """
+        Plans epoch next, as shard of num_shards if given. The activity
+        index, track lengths and usable tracks worked out so far are kept.
+        """
+        shard = self.shard if shard is None else shard
+        num_shards = self.num_shards if num_shards is None else num_shards
+        if not 0 <= shard < num_shards:
+            raise ValueError("Shard %d out of range for %d shards" % (shard, num_shards))
+        self.epoch = epoch
+        self.shard = shard
+        self.num_shards = num_shards
+
+    def set_dataset(self, dataset):
+        """
+        Reads the tracks from dataset, the same split opened again.
+        """
+        self.dataset = self.activity.dataset = dataset
+
+    def track_length(self, index):
+        if index not in self.lengths:
+            track = self.dataset.open_track(index)
+            self.lengths[index] = track["mix_stft"].shape[1]
+            track.close()
+        return self.lengths[index]
+
+    def usable_tracks(self):
+        """
+        The indices of the tracks the plan draws from: those longer than a
+        window, without those whose stored activity has no active window.
+        Tracks without stored activity are kept, data_gen looks for their
+        active windows while reading.
+        """
+        if self.usable is None:
+            usable = []
+            for index in range(len(self.dataset)):
+                starts, probabilities = self.activity.active_windows(index)
+                if self.track_length(index) > config.max_phr_len and (starts is None or len(starts) > 0):
+                    usable.append(index)
+            if not usable:
+                raise ValueError("No track with an active window to draw from")
+            self.usable = np.array(usable, dtype=np.int64)
+        return self.usable
+
+    def tracks(self, position, count):
+        """
+        count tracks of the sequence of permutations, from position on.
+        """
+        usable = self.usable_tracks()
+        num_tracks = len(usable)
+        tracks = np.empty(count, dtype=np.int64)
+        for i in range(count):
+            permutation, offset = divmod(position+i, num_tracks)
+            if permutation not in self.permutations:
+                # only the permutations in use are kept
+                self.permutations = {permutation: np.random.RandomState([self.seed, 0, permutation]).permutation(num_tracks)}
+            tracks[i] = usable[self.permutations[permutation][offset]]
+        return tracks
+
+    def batch(self, k, num_batches, files, sources=1, windows=1):
+        """
+        tracks, starts, rng = batch(k, num_batches, files, sources, windows)
+
+        The plan of batch k of num_batches of this shard in the epoch:
+        files groups of sources tracks, (files, sources) indices into
+        dataset, and windows start frames in each track, (files, sources,
+        windows). With one source the windows are active ones; a start is
+        -1 if the track has no stored activity, to be drawn while reading
+        with rng, the generator of the batch. With several sources (the
+        remixed batches of data_aug) they are uniform over the track.
+        """
+        if self.mode == 'legacy':
+            rng = np.random
+            tracks = np.empty((files, sources), dtype=np.int64)
+        else:
+            rng = np.random.RandomState([self.seed, 1, self.epoch, k, self.shard])
+            position = ((self.epoch*num_batches + k)*self.num_shards + self.shard)*files*sources
+            tracks = self.tracks(position, files*sources).reshape(files, sources)
+
+        starts = np.full((files, sources, windows), -1, dtype=np.int64)
+        for i in range(files):
+            for source in range(sources):
+                if self.mode == 'legacy':
+                    usable = self.usable_tracks()
+                    tracks[i, source] = usable[rng.randint(0, len(usable))]
+                index = tracks[i, source]
+                for j in range(windows):
+                    if sources > 1:
+                        starts[i, source, j] = rng.randint(0, self.track_length(index)-config.max_phr_len)
+                    else:
+                        start = self.activity.sample(index, rng)
+                        if start is not None:
+                            starts[i, source, j] = start
+        return tracks, starts, rng
+
+class MemoryDataset(object):
+    """
+    The tracks of the on-disk split mode (see open_disk_dataset) loaded
+    once into two arrays in shared memory, one per feature, holding the
+    tracks one after the other along the frames axis like a
+    ConsolidatedDataset, with the same offsets and lengths index. Windows
+    are served by slicing them. The arrays are stored as storage
+    ('float32' or 'float16', decoded to float32 as they are read) and
+    hold as many tracks, in order, as fit in max_bytes (nbytes is what
+    they take); the other ones are read from disk. The shared memory is
+    inherited by processes forked after it is loaded, such as the
+    BatchLoader workers, without being copied.
+    """
+    def __init__(self, mode='Train', storage=config.dataset_cache, max_bytes=config.dataset_cache_bytes):
+        self.mode = mode
+        self.disk_datasets = {}
+        dataset = self.disk_dataset()
+        self.names = dataset.names
+
+        self.lengths = np.zeros(len(dataset), dtype=np.int64)
+        for index in range(len(dataset)):
+            track = dataset.open_track(index)
+            self.lengths[index] = track["mix_stft"].shape[1]
+            track.close()
+
+        # tracks are cached in order, until the next one doesn't fit
+        frame_bytes = config.channels*5*config.features*utils.storage_dtype(storage).itemsize
+        cached = np.cumsum(self.lengths)*frame_bytes <= max_bytes
+        self.offsets = np.where(cached, np.cumsum(self.lengths)-self.lengths, -1)
+        n_frames = int(self.lengths[cached].sum())
+        self.nbytes = n_frames*frame_bytes
+
+        self.feats = {}
+        for name, channels in (("mix_stft", config.channels), ("tar_stft", config.channels*4)):
+            shape = (channels, n_frames, config.features)
+            buffer = multiprocessing.RawArray('b', int(np.prod(shape))*utils.storage_dtype(storage).itemsize)
+            self.feats[name] = utils.StoredFeature(np.frombuffer(buffer, dtype=utils.storage_dtype(storage)).reshape(shape),
+                                                   storage)
+
+        for count, index in enumerate(np.flatnonzero(cached), 1):
+            track = dataset.open_track(index)
+            for name, feat in self.feats.items():
+                offset = self.offsets[index]
+                for start in range(0, self.lengths[index], 4096):
+                    stop = min(start+4096, self.lengths[index])
+                    feat.stored[:, offset+start:offset+stop, :] = track[name][:, start:stop, :]
+            track.close()
+            utils.progress(count, int(cached.sum()), suffix='loaded in memory')
+        print()
+
+    def disk_dataset(self):
+        """
+        The on-disk split, opened once per process, for the tracks that
+        aren't in memory.
+        """
+        pid = os.getpid()
+        if pid not in self.disk_datasets:
+            self.disk_datasets[pid] = open_disk_dataset(self.mode)
+        return self.disk_datasets[pid]
+
+    def __len__(self):
+        return len(self.names)
+
+    def open_track(self, index):
+        if self.offsets[index] < 0:
+            return self.disk_dataset().open_track(index)
+        return ConsolidatedTrack(self, index)
+
+    def activity(self, index):
+        return self.disk_dataset().activity(index)
+
+    def close(self):
+        # kept for the next epochs, see memory_dataset
+        pass
+
+_memory_datasets = {}
+
+def memory_dataset(mode = 'Train'):
+    """
+    The MemoryDataset of mode, loaded on the first call and then kept for
+    the life of the process (and of the processes forked from it). The
+    splits share config.dataset_cache_bytes: each one gets what the
+    splits loaded before it left.
+    """
+    key = (mode, config.dataset_format, config.dataset_cache, config.dataset_cache_bytes)
+    if key not in _memory_datasets:
+        used = sum(dataset.nbytes for other, dataset in _memory_datasets.items() if other[1:] == key[1:])
+        _memory_datasets[key] = MemoryDataset(mode, config.dataset_cache, config.dataset_cache_bytes - used)
+    return _memory_datasets[key]
+
+def open_dataset(mode = 'Train'):
+    """
+    Opens the Train or Val split: the shared memory_dataset if
+    config.dataset_cache is set, the files of open_disk_dataset otherwise.
+    """
+    if config.dataset_cache is not None:
+        return memory_dataset(mode)
+    return open_disk_dataset(mode)
+
+def open_disk_dataset(mode = 'Train'):
+    """
+    Opens the Train or Val split in the config.dataset_format format:
+    'tracks' for the per-track files of config.dir_hdf5/dir_hdf5_test,
+    'consolidated' for config.h5py_file_train/h5py_file_val, 'npy' for the
+    shards of config.npy_dir_train/npy_dir_val.
+    """
+    if config.dataset_format == 'consolidated':
+        return ConsolidatedDataset(config.h5py_file_train if mode == "Train" else config.h5py_file_val)
+    if config.dataset_format == 'npy':
+        return NpyDataset(config.npy_dir_train if mode == "Train" else config.npy_dir_val)
+    return TrackDataset(config.dir_hdf5 if mode == "Train" else config.dir_hdf5_test)
+
+_samplers = {}
+
+def epoch_sampler(mode, dataset):
+    """
+    The EpochSampler of split mode in this process, created on the first
+    call and then kept, so the activity index, track lengths and usable
+    tracks are only worked out once, not at every epoch. dataset is the
+    split as opened by the caller, which the sampler reads from; set the
+    epoch and shard with set_epoch.
+    """
+    key = (os.getpid(), mode, tuple(dataset.names), config.sampler_seed, config.sampler_mode,
+           config.activity_threshold, config.activity_weighted)
+    if key not in _samplers:
+        _samplers[key] = EpochSampler(dataset, seed=config.sampler_seed, mode=config.sampler_mode)
+    _samplers[key].set_dataset(dataset)
+    return _samplers[key]
+
+def data_gen(mode = 'Train', data_aug = False, num_batches = None, epoch = 0, shard = 0, num_shards = 1):
+    """
+    Yields num_batches (inputs, targets) training batches of mode, of the
+    shapes of batch_shapes, normalised with the min/max of stats.hdf5.
+
+    The samples are planned by the epoch_sampler of mode for epoch, as
+    shard of num_shards of this training process (itself
+    config.sampler_shard of config.sampler_num_shards).
+
+    The windows are read straight into two float32 arrays allocated once,
+    which are normalised in place once they are full, so the same two
+    arrays are yielded for every batch: a batch is only valid until the
+    next one is requested.
+    """
+    with h5py.File(config.stat_dir+'stats.hdf5', mode='r') as stat_file:
+        max_feat = np.array(stat_file["feats_maximus"], dtype=np.float32)
+        min_feat = np.array(stat_file["feats_minimus"], dtype=np.float32)
+
+    # (x-min)/(max-min), with the reciprocals of the ranges computed once
     min_feat_tars = min_feat[:8,:].reshape(1,8,1,513)
+    scale_tars = (1.0/(max_feat[:8,:]-min_feat[:8,:])).reshape(1,8,1,513)
 
-    max_feat_ins = max_feat[-2:,:].reshape(1,2,1,513)
     min_feat_ins = min_feat[-2:,:].reshape(1,2,1,513)
-    
-    if mode == "Train":
-        in_dir=config.dir_hdf5
-        num_batches = config.batches_per_epoch_train
-    elif mode =="Val":
-        in_dir = config.dir_hdf5_test
-        num_batches = config.batches_per_epoch_val
+    scale_ins = (1.0/(max_feat[-2:,:]-min_feat[-2:,:])).reshape(1,2,1,513)
+
+    if num_batches is None:
+        num_batches = config.batches_per_epoch_train if mode == "Train" else config.batches_per_epoch_val
 
     sources = range(4)
     
-    file_list = [x for x in os.listdir(in_dir) if x.endswith('.hdf5') and not x.startswith('._')]
-
-    max_files_to_process = int(config.batch_size/config.samples_per_file)
+    dataset = open_dataset(mode)
+    # closed however the generator ends, so the handles it acquired are released
+    try:
+        sampler = epoch_sampler(mode, dataset)
+        sampler.set_epoch(epoch, config.sampler_shard*num_shards + shard, config.sampler_num_shards*num_shards)
 
+        max_files_to_process = int(config.batch_size/config.samples_per_file)
 
-    num_files = len(file_list)
+        inputs, targets = [np.zeros(shape, dtype=np.float32) for shape in batch_shapes()]
 
-    for k in range(num_batches):
+        for k in range(num_batches):
 
-        inputs = []
-        targets = []
+            count = 0
 
-        #start_time = time.time()
-
-        for i in range(max_files_to_process):
-        
             if data_aug is True:
-                #p = np.random.random_sample()
-                p = 0.1
-                print (p)
-                if p < 0.4:
-                    mix_stft = []
-                    print ("IEE")
-                    for source in sources:
-                        print (source)
-                        file_index = np.random.randint(0,num_files)
-                        file_to_open = file_list[file_index]
-
-                        hdf5_file = h5py.File(in_dir+file_to_open, "r")
-
-                        source_stft = hdf5_file["tar_stft"]
-                        
-                        file_len = source_stft.shape[1]
-                                                
-                        source_stft_c = source_stft[source*2:source*2+2,:,:]
-                        for j in range(config.samples_per_file):
-                            index=np.random.randint(0,file_len-config.max_phr_len)
-                            source_stft_f = source_stft_c[:,index:index+config.max_phr_len,:]
-                            
-                        if source is 0:
-                            mix_stft = source_stft_f
-                            targets_all = source_stft_f
-                        else:
-                            mix_stft += source_stft_f
-                            targets_all =np.concatenate((targets_all,source_stft_f), axis = 0)
-                        
-                    targets.append(targets_all)
-                    inputs.append(mix_stft)
-                #yield inputs, targets
-
-                    
+                tracks, starts, rng = sampler.batch(k, num_batches, max_files_to_process, len(sources))
             else:
-                file_index = np.random.randint(0,num_files)
-                
-                file_to_open = file_list[file_index]
-
-                hdf5_file = h5py.File(in_dir+file_to_open, "r")
-
-                tar_stft = hdf5_file["tar_stft"]
-
-                mix_stft = hdf5_file['mix_stft']
-
-
-
-                file_len = mix_stft.shape[1]
-                # start_time = time.time()
-                for j in range(config.samples_per_file):
-                    flag = False
-                    while flag is False:
-                        index=np.random.randint(0,file_len-config.max_phr_len)#;print ('small')
-                    # targets.append(np.concatenate((voc_stft[:,index:index+config.max_phr_len,:],drums_stft[:,index:index+config.max_phr_len,:],bass_stft[:,index:index+config.max_phr_len,:],acc_stft[:,index:index+config.max_phr_len,:]),axis=0))
-                        #import pdb;pdb.set_trace()
-                        if mix_stft[:,index:index+config.max_phr_len,:425].mean() > 0.02:
-                            targets.append(tar_stft[:,index:index+config.max_phr_len,:])
-                            inputs.append(mix_stft[:,index:index+config.max_phr_len,:])
-                            flag = True
-                hdf5_file.close()
-
-                # print("One file took %0.00f" % (time.time()-start_time))
-            #import pdb;pdb.set_trace()
-            targets_norm = (np.array(targets)-min_feat_tars)/(max_feat_tars-min_feat_tars)
-            inputs_norm = (np.array(inputs)-min_feat_ins)/(max_feat_ins-min_feat_ins)
-            #yield inputs, targets
-        yield inputs_norm, targets_norm
-            
-def get_stats():
-    in_dir=config.dir_hdf5
-    num_batches = config.batches_per_epoch_train
-
-    maximus = np.zeros((10,1,513))
-
-    minimus = np.ones((10,1,513))*100
+                tracks, starts, rng = sampler.batch(k, num_batches, max_files_to_process, 1, config.samples_per_file)
 
-    count =0
-
-    file_list = [x for x in os.listdir(in_dir) if x.endswith('.hdf5') and not x.startswith('._')]
-
-    for file_to_open in file_list:
-        hdf5_file = h5py.File(in_dir+file_to_open, "r")
-
-        tar_stft = np.array(hdf5_file["tar_stft"])
-
-        tar_stft_max = tar_stft.max(axis = 1).reshape(8,1,513)
-
-        tar_stft_min = tar_stft.min(axis = 1).reshape(8,1,513)
-
-        mix_stft = np.array(hdf5_file["mix_stft"])
-        mix_stft_max = mix_stft.max(axis = 1).reshape(2,1,513)
-        mix_stft_min = mix_stft.min(axis = 1).reshape(2,1,513)
-
-        if np.isnan(tar_stft).any():
-            print "tar nan"
-            print file_to_open
-        if np.isnan(mix_stft).any():
-            print "mix nan"
-            print file_to_open
-
-        loc_max = np.concatenate((tar_stft_max,mix_stft_max),axis=0)
-
-        loc_min = np.concatenate((tar_stft_min,mix_stft_min),axis=0)
-
-        maximus = np.concatenate((maximus,loc_max),axis=1).max(axis=1).reshape(10,1,513)
-
-        minimus = np.concatenate((minimus,loc_min),axis=1).min(axis=1).reshape(10,1,513)
-        utils.progress(count,100)
-        count+=1
-
-    #import pdb;pdb.set_trace()
-
-    hdf5_file = h5py.File(config.stat_dir+'stats.hdf5', mode='w')
-
-    hdf5_file.create_dataset("feats_maximus", [10,513], np.float32) 
-    hdf5_file.create_dataset("feats_minimus", [10,513], np.float32)   
-    hdf5_file["feats_maximus"][:] = maximus.reshape(10,513)
-    hdf5_file["feats_minimus"][:] = minimus.reshape(10,513)
+            for i in range(max_files_to_process):
+        
+                if data_aug is True:
+                    #p = np.random.random_sample()
+                    p = 0.1
+                    if p < 0.4:
+                        # a mixture of the stems of random windows of four
+                        # random tracks
+                        for source in sources:
+                            hdf5_file = dataset.open_track(tracks[i,source])
+
+                            source_stft = hdf5_file["tar_stft"]
+
+                            index = starts[i,source,0]
+                            source_stft.read_into(targets[count,source*2:source*2+2],
+                                                  np.s_[source*2:source*2+2,index:index+config.max_phr_len,:])
+                            hdf5_file.close()
+
+                        np.sum(targets[count].reshape(4,2,config.max_phr_len,513), axis=0, out=inputs[count])
+                        count += 1
+
+                else:
+                    hdf5_file = dataset.open_track(tracks[i,0])
+
+                    tar_stft = hdf5_file["tar_stft"]
+
+                    mix_stft = hdf5_file['mix_stft']
+
+                    file_len = mix_stft.shape[1]
+
+                    for j in range(config.samples_per_file):
+                        index = starts[i,0,j]
+                        if index >= 0:
+                            mix_stft.read_into(inputs[count], np.s_[:,index:index+config.max_phr_len,:])
+                        # tracks converted without the activity index are
+                        # sampled by reading random windows until one is active,
+                        # or keep the last one if the track seems to have none
+                        tries = 0
+                        while index < 0:
+                            index=rng.randint(0,file_len-config.max_phr_len)
+                            mix_stft.read_into(inputs[count], np.s_[:,index:index+config.max_phr_len,:])
+                            tries += 1
+                            if inputs[count,:,:,:config.activity_bins].mean() <= config.activity_threshold and tries < 100:
+                                index = -1
+                        tar_stft.read_into(targets[count], np.s_[:,index:index+config.max_phr_len,:])
+                        count += 1
+                    hdf5_file.close()
+
+            inputs -= min_feat_ins
+            inputs *= scale_ins
+            targets -= min_feat_tars
+            targets *= scale_tars
+
+            yield inputs[:count], targets[:count]
+    finally:
+        dataset.close()
+
+def batch_shapes():
+    """
+    Shapes of the inputs and targets of a data_gen batch.
+    """
+    samples = int(config.batch_size/config.samples_per_file)*config.samples_per_file
+    return ((samples, config.channels, config.max_phr_len, config.features),
+            (samples, config.channels*4, config.max_phr_len, config.features))
+
+def _loader_worker(mode, data_aug, seed, worker, workers, num_batches, buffers, free_slots, ready_slots,
+                   pool_counters):
+    np.random.seed(seed)
+    try:
+        epoch = 0
+        while True:
+            for inputs, targets in data_gen(mode, data_aug, num_batches, epoch, worker, workers):
+                slot = free_slots.get()
+                buffers[slot][0][...] = inputs
+                buffers[slot][1][...] = targets
+                pool = handle_pool()
+                pool_counters[worker*3:worker*3+3] = [pool.hits, pool.misses, pool.evictions]
+                ready_slots.put(slot)
+            epoch += 1
+    except Exception:
+        ready_slots.put(traceback.format_exc())
+
+class BatchLoader(object):
+    """
+    Runs data_gen(mode, data_aug) in workers processes, each seeded
+    differently, which write the batches into a ring of depth
+    shared-memory buffers; only the index of a buffer goes through the
+    queues. Iterating over the loader gives the batches of an epoch (the
+    number of batches per epoch of mode) as float32 arrays in the shared
+    buffers, which stay valid until the next batch is requested. The
+    workers keep filling free buffers while the trainer works, and
+    wait_time accumulates how long the trainer waited for a batch (see
+    stats). With workers=0, data_gen runs in the trainer's process. The
+    trainer holds one buffer while the workers fill the others, so depth
+    must be at least 2.
+
+    The workers are always forked, whatever the start method of
+    multiprocessing, since the buffers (and the MemoryDataset) are only
+    shared with forked processes. A worker that dies, or fails, makes
+    iterating raise RuntimeError instead of waiting forever.
+
+    Each worker is a shard of the EpochSampler and draws its share of the
+    batches of an epoch, then moves on to its next epoch, so with the
+    'epoch' sampler the workers never draw the same samples. The batches
+    depend on config.sampler_seed and on workers, which sets both the
+    number of shards and the batches each one draws per epoch (and the
+    order in which the workers deliver them is not deterministic). seed
+    only seeds np.random, for the 'legacy' sampler.
+    """
+    def __init__(self, mode='Train', data_aug=False, workers=config.loader_workers,
+                 depth=config.loader_depth, seed=None):
+        self.mode = mode
+        self.data_aug = data_aug
+        self.workers = workers
+        self.num_batches = config.batches_per_epoch_train if mode == "Train" else config.batches_per_epoch_val
+        self.wait_time = 0.0
+        self.batches = 0
+        self.epoch = 0
+        self.processes = []
+        if workers == 0:
+            return
+
+        if depth < 2:
+            raise ValueError("BatchLoader needs a depth of at least 2, got %d" % depth)
+
+        if seed is None:
+            seed = np.random.randint(2**31 - workers)
+
+        if config.dataset_cache is not None:
+            # loaded before the workers are forked, so they share it
+            memory_dataset(mode)
+
+        context = multiprocessing.get_context('fork')
+
+        self.buffers = []
+        for slot in range(depth):
+            self.buffers.append(tuple(
+                np.frombuffer(context.RawArray('f', int(np.prod(shape))), dtype=np.float32).reshape(shape)
+                for shape in batch_shapes()))
+
+        # the hits, misses and evictions of the handle_pool of each worker
+        self.pool_counters = context.RawArray('q', workers*3)
+
+        self.free_slots = context.Queue()
+        self.ready_slots = context.Queue()
+        for slot in range(depth):
+            self.free_slots.put(slot)
+        self.used_slot = None
+
+        for worker in range(workers):
+            process = context.Process(target=_loader_worker,
+                                      args=(mode, data_aug, seed+worker, worker, workers,
+                                            -(-self.num_batches//workers), self.buffers,
+                                            self.free_slots, self.ready_slots, self.pool_counters))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        if self.workers == 0:
+            batches = data_gen(self.mode, self.data_aug, self.num_batches, self.epoch)
+            self.epoch += 1
+            for k in range(self.num_batches):
+                start_time = time.time()
+                batch = next(batches)
+                self._waited(start_time)
+                yield batch
+            return
+
+        for k in range(self.num_batches):
+            start_time = time.time()
+            slot = self._ready_slot()
+            if not isinstance(slot, int):
+                raise RuntimeError("BatchLoader worker failed:\n" + slot)
+            self._waited(start_time)
+            # the previous batch is only given back once the next one is
+            # in hand, so the workers refilling it don't delay this one
+            if self.used_slot is not None:
+                self.free_slots.put(self.used_slot)
+            self.used_slot = slot
+            yield self.buffers[slot]
+
+    def _ready_slot(self, poll=1.0):
+        while True:
+            try:
+                return self.ready_slots.get(timeout=poll)
+            except queue.Empty:
+                for process in self.processes:
+                    if not process.is_alive():
+                        raise RuntimeError("BatchLoader worker %d exited with code %s"
+                                           % (process.pid, process.exitcode))
+
+    def _waited(self, start_time):
+        self.wait_time += time.time() - start_time
+        self.batches += 1
+
+    def stats(self):
+        """
+        Total and mean time the trainer waited for a batch, in seconds.
+        """
+        return {"batches": self.batches, "wait_time": self.wait_time,
+                "mean_wait": self.wait_time/max(self.batches, 1)}
+
+    def pool_stats(self):
+        """
+        The hits, misses and evictions of the handle pools of the workers,
+        as of their last batch, added up. See also loader_pool_stats.
+        """
+        if self.workers == 0:
+            return handle_pool().stats()
+        counters = np.array(self.pool_counters[:]).reshape(-1, 3).sum(axis=0)
+        return {"hits": int(counters[0]), "misses": int(counters[1]), "evictions": int(counters[2])}
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        self.processes = []
+
+def loader_pool_stats(*loaders):
+    """
+    The hits, misses and evictions of the handle pools used by loaders,
+    added up: those of their workers, and the pool of this process once
+    if any of them runs data_gen in it.
+    """
+    totals = collections.Counter()
+    for loader in loaders:
+        if loader.workers > 0:
+            totals.update(loader.pool_stats())
+    if any(loader.workers == 0 for loader in loaders):
+        pool = handle_pool()
+        totals.update({"hits": pool.hits, "misses": pool.misses, "evictions": pool.evictions})
+    return totals
+
+def scan_track(in_file, block_frames=4096):
+    """
+    stats, report = scan_track(in_file)
+
+    Reads the feature file in_file block_frames frames at a time and
+    returns its utils.FeatureStats and an integrity report: the number of
+    frames, the NaN and Inf values of each feature, the silent frames (an
+    all-zero mixture) and the inactive ones (activity not above
+    config.activity_threshold, which data_gen never draws). Values that
+    are not finite are left out of the statistics.
+    """
+    stats = utils.FeatureStats()
+    report = {"name": os.path.basename(in_file), "frames": 0,
+              "nan": {"mix_stft": 0, "tar_stft": 0}, "inf": {"mix_stft": 0, "tar_stft": 0},
+              "silent_frames": 0, "inactive_frames": 0}
+
+    with h5py.File(in_file, "r") as hdf5_file:
+        n_frames = hdf5_file["mix_stft"].shape[1]
+        report["frames"] = int(n_frames)
+        for start in range(0, n_frames, block_frames):
+            feats = {}
+            for feat in ("tar_stft", "mix_stft"):
+                feats[feat] = utils.StoredFeature(hdf5_file[feat])[:, start:start+block_frames, :]
+                report["nan"][feat] += int(np.isnan(feats[feat]).sum())
+                report["inf"][feat] += int(np.isinf(feats[feat]).sum())
+            mix_stft = feats["mix_stft"]
+            report["silent_frames"] += int((mix_stft == 0).all(axis=(0, 2)).sum())
+            activity = mix_stft[:, :, :config.activity_bins].mean(axis=(0, 2))
+            report["inactive_frames"] += int((~(activity > config.activity_threshold)).sum())
+            block = np.concatenate((feats["tar_stft"], mix_stft), axis=0)
+            if not np.isfinite(block).all():
+                # frames with a value that is not finite are left out
+                block = block[:, np.isfinite(block).all(axis=(0, 2)), :]
+            stats.update(block)
+
+    report["ok"] = not any(report["nan"].values()) and not any(report["inf"].values())
+    return stats, report
+
+def _scan_job(in_file):
+    # a file that can't be read is reported with its error, so that the
+    # others are still scanned
+    try:
+        return scan_track(in_file)
+    except Exception as error:
+        return None, {"name": os.path.basename(in_file), "error": "%s: %s" % (type(error).__name__, error)}
+
+def get_stats(in_dir=None, workers=config.prep_workers, stat_dir=config.stat_dir):
+    """
+    Recomputes stats.hdf5 (see utils.FeatureStats.save) over the feature
+    files of in_dir, the train set by default, scanning them in parallel
+    with scan_track and merging the results. The per-track reports are
+    written to integrity.json in stat_dir, with a summary of the tracks
+    that have NaN or Inf values and of the files that could not be read,
+    which are left out of the statistics.
+    """
+    if in_dir is None:
+        in_dir = config.dir_hdf5
+
+    file_list = [os.path.join(in_dir, x) for x in feature_files(in_dir)]
+
+    stats = utils.FeatureStats()
+    reports = []
+    failed = []
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for count, (track_stats, report) in enumerate(pool.imap_unordered(_scan_job, file_list), 1):
+            if track_stats is None:
+                failed.append(report)
+            else:
+                stats.merge(track_stats)
+                reports.append(report)
+            utils.progress(count, len(file_list), suffix=report["name"])
+    except BaseException:
+        # KeyboardInterrupt included: don't wait for the queued files
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    print()
+
+    stats.save(stat_dir)
+
+    reports.sort(key=lambda report: report["name"])
+    report = {"tracks": reports,
+              "summary": {"tracks": len(reports), "frames": sum(r["frames"] for r in reports),
+                          "silent_frames": sum(r["silent_frames"] for r in reports),
+                          "inactive_frames": sum(r["inactive_frames"] for r in reports),
+                          "corrupt": [r["name"] for r in reports if not r["ok"]],
+                          "unreadable": sorted(failed, key=lambda report: report["name"])}}
+    with open(os.path.join(stat_dir, 'integrity.json'), 'w') as report_file:
+        json.dump(report, report_file, indent=1)
+
+    for name in report["summary"]["corrupt"]:
+        print("NaN or Inf values in %s" % name)
+    for failure in report["summary"]["unreadable"]:
+        print("Failed to read %s: %s" % (failure["name"], failure["error"]))
+
+    return stats, report
     
 def main():
     # get_stats(feat='feats')
@@ -0,0 +1,199 @@
+"""
+Torch implementation of the DSP helpers in utils (stft, istft, the
+overlap-add chunking helpers and the stereo wrappers), selected with
+utils.get_dsp_backend('torch') or config.dsp_backend = 'torch'.
+
+Every function takes numpy arrays or tensors and returns tensors on
+config.dsp_device, so the separate-and-resynthesise path in evalNetwork
+stays in torch and runs on the intra-op thread pool. The scaling, window
+and padding match utils exactly, so both backends give the same results
+within float tolerance.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import soundfile as sf
+
+import config
+import utils
+
+
+def _device():
+    # read at every call, so config.dsp_device can be changed after import
+    return torch.device(config.dsp_device)
+
+def asarray(data):
+    return torch.as_tensor(data, device=_device())
+
+def to_numpy(data):
+    return data.detach().cpu().numpy()
+
+def to_model(batch):
+    return batch.float()
+
+def from_model(output):
+    return output.detach().to(_device())
+
+def stack(arrays):
+    return torch.stack(list(arrays))
+
+def get_dtype(dtype=None):
+    """
+    Torch counterpart of utils.get_dtype.
+    """
+    return getattr(torch, utils.get_dtype(dtype).name)
+
+def _window(window, data):
+    return torch.as_tensor(window, dtype=data.real.dtype, device=data.device)
+
+def stft(data, window=np.hanning(1024),
+         hopsize=256.0, nfft=1024.0, fs=44100.0, dtype=None):
+    """
+    Torch version of utils.stft, for data of shape (..., samples).
+    """
+    data = asarray(data).to(get_dtype(dtype))
+    lengthWindow = window.size
+    lengthData = data.shape[-1]
+
+    numberFrames = int(np.ceil(lengthData / np.double(hopsize))) + 2
+    newLengthData = int((numberFrames-1) * hopsize + lengthWindow)
+
+    data = F.pad(data, (int(lengthWindow/2), newLengthData-lengthData-int(lengthWindow/2)))
+
+    frames = data.unfold(-1, lengthWindow, int(hopsize)) * _window(window, data)
+
+    return torch.fft.rfft(frames, int(nfft), norm="ortho")
+
+def overlap_add(frames, hopsize):
+    """
+    Torch version of utils.overlap_add, done as a single scatter-add with
+    F.fold.
+    """
+    numberFrames, lengthWindow = frames.shape[-2:]
+    lengthData = int(hopsize)*(numberFrames-1) + lengthWindow
+
+    columns = frames.reshape(-1, numberFrames, lengthWindow).transpose(1, 2)
+    data = F.fold(columns, output_size=(1, lengthData),
+                  kernel_size=(1, lengthWindow), stride=(1, int(hopsize)))
+
+    return data.reshape(frames.shape[:-2] + (lengthData,))
+
+def istft(mag, phase, window=np.hanning(1024),
+         hopsize=256.0, nfft=1024.0, fs=44100.0,
+          analysisWindow=None, dtype=None):
+    """
+    Torch version of utils.istft, for mag and phase of shape
+    (..., frames, nfft/2+1).
+    """
+    mag, phase = asarray(mag).to(get_dtype(dtype)), asarray(phase).to(get_dtype(dtype))
+    if analysisWindow is None:
+        analysisWindow = window
+
+    lengthWindow = window.size
+    numberFrames = mag.shape[-2]
+
+    X = mag * torch.exp(1j*phase)
+    frames = torch.fft.irfft(X, int(nfft), norm="ortho")
+    frames = frames[..., :lengthWindow] * _window(window, frames)
+
+    data = overlap_add(frames, hopsize)[..., int(lengthWindow/2.0):]
+
+    normalisationSeq = utils.normalisation_envelope(numberFrames, hopsize,
+                                                    window, analysisWindow)
+
+    normalisationSeq = torch.from_numpy(normalisationSeq.copy()).to(data)
+
+    return data / normalisationSeq
+
+def stft_stereo(data, phase=False, dtype=None):
+    assert data.shape[1] == 2
+    stft_lr = stft(asarray(data).T, dtype=dtype)
+    if phase:
+        return stft_lr.abs(),stft_lr.angle()
+    else:
+        return stft_lr.abs()
+
+def inverse_stft(mix_stft,mix_phase):
+    return istft(mix_stft,mix_phase).transpose(-1,-2)
+
+def inverse_stft_write(mix_stft,mix_phase,file_name,subtype=None):
+    sf.write(file_name,to_numpy(inverse_stft(mix_stft,mix_phase)),config.fs,subtype=subtype)
+
+def write_stems(stems,mix_phase,file_names,threads=config.synth_threads):
+    """
+    Torch version of utils.write_stems: all the stems are resynthesised at
+    once and written from a pool of threads.
+    """
+    audio_out = to_numpy(inverse_stft(stack(stems),mix_phase))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda audio, file_name: sf.write(file_name,audio,config.fs),
+                      audio_out,file_names))
+
+def generate_overlapadd(allmix,time_context=config.max_phr_len, overlap=config.max_phr_len/2,batch_size=config.batch_size,dtype=None):
+    """
+    Torch version of utils.generate_overlapadd. The chunks are taken with
+    unfold and only copied once, into the batched output.
+    """
+    allmix = asarray(allmix).to(get_dtype(dtype))
+    step = int(time_context - overlap)
+
+    # same number of chunks as the while loop in utils, which requires
+    # start + time_context < frames
+    nchunks = max(int(np.ceil((allmix.shape[1]-time_context)/float(step))), 0)
+
+    if nchunks > 0:
+        chunks = allmix.unfold(1, time_context, step)[:,:nchunks].permute(1,0,3,2)
+    else:
+        chunks = allmix.new_zeros((0,allmix.shape[0],time_context,allmix.shape[-1]))
+
+    nbatches = int(np.ceil(float(nchunks)/batch_size))
+    fbatch = torch.full((nbatches*batch_size,)+chunks.shape[1:], 1e-10,
+                        dtype=allmix.dtype, device=allmix.device)
+    fbatch[:nchunks] = chunks
+
+    return fbatch.reshape((nbatches,batch_size)+chunks.shape[1:]),nchunks
+
+def overlapadd(fbatch,nchunks,overlap=int(config.max_phr_len/2),dtype=None):
+    """
+    Torch version of utils.overlapadd.
+    """
+    fbatch = asarray(fbatch).to(get_dtype(dtype))
+    input_size=fbatch.shape[-1]
+    time_context=fbatch.shape[-2]
+    channels=fbatch.shape[-3]
+    lead=tuple(fbatch.shape[:-5])
+
+    fade_in = torch.linspace(0., 1.0, overlap, dtype=fbatch.dtype, device=fbatch.device).unsqueeze(1)
+    fade_out = fade_in.flip(0)
+
+    chunks = fbatch.reshape(lead+(-1,channels,time_context,input_size))[...,:nchunks,:,:,:]
+
+    sep = fbatch.new_zeros(lead+(channels,int(nchunks*(time_context-overlap)+time_context),input_size))
+
+    if nchunks == 0:
+        return sep
+
+    if time_context == 2*overlap:
+        # every chunk only crossfades with the one before it, so all the
+        # crossfades can be done at once
+        first = chunks[...,:overlap,:]
+        second = chunks[...,overlap:,:]
+        faded = fade_out*second[...,:-1,:,:,:] + fade_in*first[...,1:,:,:,:]
+        blocks = torch.cat((first[...,:1,:,:,:],faded,second[...,-1:,:,:,:]),-4)
+        blocks = blocks.movedim(-4,-3).reshape(lead+(channels,-1,input_size))
+        sep[...,:(nchunks+1)*overlap,:] = blocks
+        return sep
+
+    start=0
+    for i in range(nchunks):
+        sa = chunks[...,i,:,:,:]
+        if start==0:
+            sep[...,0:time_context,:] = sa
+        else:
+            sep[...,start+overlap:start+time_context,:] = sa[...,overlap:time_context,:]
+            sep[...,start:start+overlap,:] = fade_out*sep[...,start:start+overlap,:] + fade_in*sa[...,:overlap,:]
+        start = int(start - overlap + time_context)
+    return sep
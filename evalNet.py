@@ -22,8 +22,10 @@ def evalNets(pcs_model = 'model_e8000_b50_bs5_3429', file_to_eval = "None", path
     autoencoder_audio.load_state_dict(torch.load(config.log_dir+pcs_model+'.pt'))
     stat_file = h5py.File(config.stat_dir+'stats.hdf5', mode='r')
 
-    max_feat = np.array(stat_file["feats_maximus"])
-    min_feat = np.array(stat_file["feats_minimus"])
+    dsp = utils.get_dsp_backend()
+
+    max_feat = dsp.asarray(np.array(stat_file["feats_maximus"]))
+    min_feat = dsp.asarray(np.array(stat_file["feats_minimus"]))
 
     max_feat_tars = max_feat[:8,:].reshape(8,1,513)
     min_feat_tars = min_feat[:8,:].reshape(8,1,513)
@@ -47,7 +49,7 @@ def evalNets(pcs_model = 'model_e8000_b50_bs5_3429', file_to_eval = "None", path
 
     for file_name in random_files:
 
-        audio,fs = stempeg.read_stems(os.path.join(config.wav_dir_test,file_name), stem_id=[0,1,2,3,4])
+        audio,fs = utils.read_stems(os.path.join(config.wav_dir_test,file_name))
 
         mixture = audio[0]
 
@@ -59,30 +61,30 @@ def evalNets(pcs_model = 'model_e8000_b50_bs5_3429', file_to_eval = "None", path
 
         vocals = audio[4]
 
-        mix_stft, mix_phase = utils.stft_stereo(mixture,phase=True)
+        mix_stft, mix_phase = dsp.stft_stereo(mixture,phase=True)
 
         mix_stft = (mix_stft-min_feat_ins)/(max_feat_ins-min_feat_ins)
 
-        drums_stft = utils.stft_stereo(drums)
+        drums_stft = dsp.stft_stereo(drums)
 
-        bass_stft = utils.stft_stereo(bass)
+        bass_stft = dsp.stft_stereo(bass)
 
-        acc_stft = utils.stft_stereo(acc)
+        acc_stft = dsp.stft_stereo(acc)
 
-        voc_stft = utils.stft_stereo(vocals)
+        voc_stft = dsp.stft_stereo(vocals)
 
-        in_batches, nchunks_in = utils.generate_overlapadd(mix_stft)
+        in_batches, nchunks_in = dsp.generate_overlapadd(mix_stft)
 
         out_batches = []
 
         for in_batch in in_batches:
             # import pdb;pdb.set_trace()
-            in_batch = Variable(torch.FloatTensor(in_batch)).cuda()
+            in_batch = Variable(dsp.to_model(in_batch)).cuda()
             out_batch = autoencoder_audio(in_batch)
-            out_batches.append(np.array(out_batch.data.cpu().numpy()))
+            out_batches.append(dsp.from_model(out_batch))
 
 
-        out_batches = np.array(out_batches)
+        out_batches = dsp.stack(out_batches)
 
         vocals = out_batches[:,:,:2,:,:]
 
@@ -118,21 +120,11 @@ def evalNets(pcs_model = 'model_e8000_b50_bs5_3429', file_to_eval = "None", path
 
         out_others = out_others*(max_feat_tars[6:,:,:]-min_feat_tars[6:,:,:])+min_feat_tars[6:,:,:]
 
-        out_drums = utils.overlapadd(out_drums, nchunks_in)
-
-        out_bass = utils.overlapadd(out_bass, nchunks_in)
-
-        out_others = utils.overlapadd(out_others, nchunks_in)
-
-        out_vocals = utils.overlapadd(out_vocals, nchunks_in)
-
-        out_drums = utils.inverse_stft(out_drums[:,:mix_phase.shape[1],:],mix_phase)
-
-        out_bass = utils.inverse_stft(out_bass[:,:mix_phase.shape[1],:],mix_phase)
+        out_drums, out_bass, out_others, out_vocals = dsp.overlapadd(dsp.stack([out_drums, out_bass, out_others, out_vocals]), nchunks_in)
 
-        out_others = utils.inverse_stft(out_others[:,:mix_phase.shape[1],:],mix_phase)
+        out_stems = dsp.stack([out_drums, out_bass, out_others, out_vocals])[:,:,:mix_phase.shape[1],:]
 
-        out_vocals = utils.inverse_stft(out_vocals[:,:mix_phase.shape[1],:],mix_phase)
+        out_drums, out_bass, out_others, out_vocals = dsp.to_numpy(dsp.inverse_stft(out_stems,mix_phase))
         
         estimated = np.transpose(np.concatenate((out_drums, out_bass, out_others, out_vocals), axis = 1)) 
         
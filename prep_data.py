@@ -1,5 +1,8 @@
 # from __future__ import division
 import os,re
+import json
+import hashlib
+import multiprocessing
 import collections
 import soundfile as sf
 import numpy as np
@@ -13,96 +16,469 @@ import stempeg
 
 import config
 import utils
-
-
-def main():
-
-    # maximus=np.zeros(66)
-    # minimus=np.ones(66)*1000
-
-
-    wav_files=[x for x in os.listdir(config.wav_dir_test) if x.endswith('.stem.mp4') and not x.startswith(".")]
-    count=0
-
-
+import data_pipeline
+
+
+def is_converted(out_file):
+    """
+    True if out_file is a complete feature file written by convert_track.
+    """
+    try:
+        with h5py.File(out_file, mode='r') as hdf5_file:
+            return bool(hdf5_file.attrs.get('complete', False)) and "mix_stft" in hdf5_file and "tar_stft" in hdf5_file
+    except (OSError, IOError):
+        return False
+
+def create_feature_datasets(hdf5_file, n_frames, chunk_frames=config.hdf5_chunk_frames,
+                            compression=config.hdf5_compression, shuffle=config.hdf5_shuffle,
+                            storage=config.feature_storage):
+    """
+    Creates the mix_stft and tar_stft datasets of a track of n_frames frames,
+    holding magnitudes encoded with utils.encode_magnitudes(mag, storage).
+
+    With chunk_frames, the datasets are chunked as (channels, chunk_frames,
+    513), so a 30 frame training window only touches one or two chunks,
+    and can be compressed ('lzf' or 'gzip', optionally with the shuffle
+    filter). chunk_frames=None gives the contiguous, uncompressed layout.
+    """
+    layout = {}
+    if chunk_frames is not None:
+        layout = dict(compression=compression, shuffle=shuffle)
+
+    for name, channels in (("mix_stft", config.channels), ("tar_stft", config.channels*4)):
+        if chunk_frames is not None:
+            layout["chunks"] = (channels, min(chunk_frames, n_frames), config.features)
+        hdf5_file.create_dataset(name, [channels, n_frames, config.features], utils.storage_dtype(storage), **layout)
+        hdf5_file[name].attrs['storage'] = storage
+
+def copy_frames(src, dst, storage, offset=0, block_frames=4096):
+    """
+    Copies the frames of the feature src (an h5py dataset or array, see
+    utils.StoredFeature) to dst, of the given storage, from frame offset
+    on, block_frames at a time. The frames are only decoded and encoded
+    again if the storages differ.
+    """
+    src = utils.StoredFeature(src)
+    for start in range(0, src.shape[1], block_frames):
+        stop = min(start+block_frames, src.shape[1])
+        if src.storage == storage:
+            dst[:, offset+start:offset+stop, :] = src.stored[:, start:stop, :]
+        else:
+            dst[:, offset+start:offset+stop, :] = utils.encode_magnitudes(src[:, start:stop, :], storage)
+
+def frame_activity(mix_stft, block_frames=4096):
+    """
+    The activity of every frame of the (2, frames, 513) mixture magnitude
+    mix_stft (read through utils.StoredFeature): its mean over both
+    channels and the first config.activity_bins bins. The mean of a
+    window of frames is the value data_gen compares to
+    config.activity_threshold, see data_pipeline.ActivityIndex.
+    """
+    mix_stft = utils.StoredFeature(mix_stft)
+    n_frames = mix_stft.shape[1]
+    activity = np.zeros(n_frames, dtype=np.float32)
+    for start in range(0, n_frames, block_frames):
+        stop = min(start+block_frames, n_frames)
+        activity[start:stop] = np.mean(mix_stft[:, start:stop, :config.activity_bins], axis=(0, 2), dtype=np.float64)
+    return activity
+
+def index_activity(in_dir):
+    """
+    Adds the activity dataset to the feature files of in_dir converted
+    before it was written by convert_track.
+    """
+    names = data_pipeline.feature_files(in_dir)
+    for count, name in enumerate(names, 1):
+        with h5py.File(os.path.join(in_dir, name), mode='r+') as hdf5_file:
+            if "activity" not in hdf5_file:
+                hdf5_file.create_dataset("activity", data=frame_activity(hdf5_file["mix_stft"]))
+        utils.progress(count, len(names))
+    print()
+
+def convert_track(in_file, out_file):
+    """
+    Writes the mix_stft and tar_stft features of the stem.mp4 track in_file
+    to out_file, with the activity of every frame (see frame_activity) and
+    the track's utils.FeatureStats in the stats group, accumulated while
+    the features are computed. The features are written to a temporary
+    file that is only renamed to out_file once it is complete.
+    """
+    # decoded without the audio cache of read_stems: a track is only
+    # converted again once it has changed, when its cache entry is stale
+    audio,fs = utils.decode_stems(in_file)
+
+    tmp_file = out_file+'.tmp'
+
+    with h5py.File(tmp_file, mode='w') as hdf5_file:
+
+        create_feature_datasets(hdf5_file, utils.stft_frames(audio.shape[1]), storage=config.feature_storage)
+
+        stats = utils.FeatureStats()
+
+        utils.stft_stems(audio, hdf5_file["mix_stft"], hdf5_file["tar_stft"], stats=stats,
+                         storage=config.feature_storage)
+
+        stats.write(hdf5_file.create_group("stats"))
+
+        hdf5_file.create_dataset("activity", data=frame_activity(hdf5_file["mix_stft"]))
+
+        hdf5_file.attrs['complete'] = True
+
+    os.replace(tmp_file, out_file)
+
+    return out_file
+
+def track_stats(in_file):
+    """
+    The utils.FeatureStats of the feature file in_file, as stored by
+    convert_track, or computed from its features for files converted
+    before they were.
+    """
+    with h5py.File(in_file, mode='r') as hdf5_file:
+        if "stats" in hdf5_file:
+            return utils.FeatureStats.read(hdf5_file["stats"])
+        stats = utils.FeatureStats()
+        stats.update_track(utils.StoredFeature(hdf5_file["tar_stft"]), utils.StoredFeature(hdf5_file["mix_stft"]))
+        return stats
+
+def write_stats(in_dir=None, stat_dir=config.stat_dir):
+    """
+    Merges the statistics of every track of in_dir, the train set by
+    default, and writes them to stat_dir with utils.FeatureStats.save.
+    """
+    if in_dir is None:
+        in_dir = config.dir_hdf5
+    names = data_pipeline.feature_files(in_dir)
+    stats = utils.FeatureStats()
+    for name in names:
+        stats.merge(track_stats(os.path.join(in_dir, name)))
+    stats.save(stat_dir)
+    return stats
+
+def storage_error(in_dir=None, stat_dir=config.stat_dir, storages=('float16', 'log_uint16'), block_frames=4096):
+    """
+    Measures the error each of storages would introduce in the features of
+    in_dir (the train set by default, converted with float32 storage), as
+    a fraction of the range of every channel and bin in stats.hdf5, that
+    is, in the units of the normalised features data_gen feeds the model.
+    The maximum and mean errors are printed and written to
+    storage_error.json in stat_dir.
+    """
+    if in_dir is None:
+        in_dir = config.dir_hdf5
+    with h5py.File(stat_dir+'stats.hdf5', mode='r') as stat_file:
+        feat_range = np.array(stat_file["feats_maximus"]) - np.array(stat_file["feats_minimus"])
+    feat_range = np.maximum(feat_range, np.finfo(np.float32).tiny)[:, None, :]
+
+    errors = dict((storage, {"max": 0.0, "sum": 0.0, "count": 0}) for storage in storages)
+
+    names = data_pipeline.feature_files(in_dir)
+    for count, name in enumerate(names, 1):
+        with h5py.File(os.path.join(in_dir, name), mode='r') as hdf5_file:
+            tar_stft = utils.StoredFeature(hdf5_file["tar_stft"])
+            mix_stft = utils.StoredFeature(hdf5_file["mix_stft"])
+            for start in range(0, mix_stft.shape[1], block_frames):
+                feats = np.concatenate((tar_stft[:, start:start+block_frames, :],
+                                        mix_stft[:, start:start+block_frames, :]), axis=0)
+                for storage, error in errors.items():
+                    decoded = utils.decode_magnitudes(utils.encode_magnitudes(feats, storage), storage)
+                    relative = np.abs(decoded.astype(np.float64) - feats)/feat_range
+                    error["max"] = max(error["max"], float(relative.max()))
+                    error["sum"] += float(relative.sum())
+                    error["count"] += relative.size
+        utils.progress(count, len(names))
+    print()
+
+    report = {}
+    for storage, error in errors.items():
+        report[storage] = {"max": error["max"], "mean": error["sum"]/max(error["count"], 1),
+                           "bytes_per_value": utils.storage_dtype(storage).itemsize}
+        print("%-12s max %.3e  mean %.3e  (of the stats.hdf5 range)" % (storage, report[storage]["max"], report[storage]["mean"]))
+
+    with open(os.path.join(stat_dir, 'storage_error.json'), 'w') as report_file:
+        json.dump(report, report_file, indent=1)
+    return report
+
+def consolidate(in_dir, out_file, block_frames=4096):
+    """
+    Concatenates the per-track feature files of in_dir along the frames
+    axis into the single file out_file, with an index of the tracks: the
+    offsets and lengths datasets give the first frame and number of
+    frames of each track, and names its file name. The activity of the
+    tracks is concatenated the same way. This is the format
+    data_pipeline.ConsolidatedDataset reads.
+    """
+    names = data_pipeline.feature_files(in_dir)
+
+    lengths = []
+    for name in names:
+        with h5py.File(os.path.join(in_dir, name), mode='r') as hdf5_file:
+            lengths.append(hdf5_file["mix_stft"].shape[1])
+    lengths = np.array(lengths, dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+
+    tmp_file = out_file+'.tmp'
+
+    with h5py.File(tmp_file, mode='w') as out_hdf5:
+        create_feature_datasets(out_hdf5, int(lengths.sum()), storage=config.feature_storage)
+        out_hdf5.create_dataset("offsets", data=offsets)
+        out_hdf5.create_dataset("lengths", data=lengths)
+        out_hdf5.create_dataset("names", data=names, dtype=h5py.special_dtype(vlen=str))
+        out_hdf5.create_dataset("activity", [int(lengths.sum())], np.float32)
+
+        for count, (name, offset, length) in enumerate(zip(names, offsets, lengths), 1):
+            with h5py.File(os.path.join(in_dir, name), mode='r') as hdf5_file:
+                for feat in ("mix_stft", "tar_stft"):
+                    copy_frames(hdf5_file[feat], out_hdf5[feat], config.feature_storage, offset, block_frames)
+                if "activity" in hdf5_file:
+                    out_hdf5["activity"][offset:offset+length] = hdf5_file["activity"][:]
+                else:
+                    out_hdf5["activity"][offset:offset+length] = frame_activity(hdf5_file["mix_stft"])
+            utils.progress(count, len(names))
+
+        out_hdf5.attrs['complete'] = True
+
+    os.replace(tmp_file, out_file)
+    print()
+
+def export_npy(in_dir, out_dir, block_frames=4096):
+    """
+    Exports the per-track feature files of in_dir as .npy shards in out_dir,
+    one per track and feature plus one for the activity of its frames, and
+    an index.json listing every track's name, number of frames and shard
+    files. This is the format data_pipeline.NpyDataset reads. The shards
+    hold magnitudes of config.feature_storage, and the ones already
+    exported with it are skipped.
+    """
+    storage = config.feature_storage
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    names = data_pipeline.feature_files(in_dir)
+
+    tracks = []
+    for count, name in enumerate(names, 1):
+        track = {"name": name, "storage": storage}
+        with h5py.File(os.path.join(in_dir, name), mode='r') as hdf5_file:
+            track["length"] = int(hdf5_file["mix_stft"].shape[1])
+            for feat in ("mix_stft", "tar_stft"):
+                track[feat] = name[:-5]+'_'+feat+'.npy'
+                shard_file = os.path.join(out_dir, track[feat])
+                if os.path.exists(shard_file) and np.load(shard_file, mmap_mode='r').dtype == utils.storage_dtype(storage):
+                    continue
+                tmp_file = shard_file+'.tmp'
+                shard = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=utils.storage_dtype(storage),
+                                                  shape=hdf5_file[feat].shape)
+                copy_frames(hdf5_file[feat], shard, storage, block_frames=block_frames)
+                shard.flush()
+                del shard
+                os.replace(tmp_file, shard_file)
+            track["activity"] = name[:-5]+'_activity.npy'
+            shard_file = os.path.join(out_dir, track["activity"])
+            if not os.path.exists(shard_file):
+                if "activity" in hdf5_file:
+                    activity = hdf5_file["activity"][:]
+                else:
+                    activity = frame_activity(hdf5_file["mix_stft"])
+                utils.save_atomic(shard_file, activity)
+        tracks.append(track)
+        utils.progress(count, len(names))
+
+    tmp_file = os.path.join(out_dir, 'index.json.tmp')
+    with open(tmp_file, 'w') as index_file:
+        json.dump({"tracks": tracks}, index_file, indent=1)
+    os.replace(tmp_file, os.path.join(out_dir, 'index.json'))
+    print()
+
+# bump whenever convert_track writes different features, so rebuilds
+# reconvert every track
+feature_version = 1
+
+def feature_params():
+    """
+    Everything the features of a track depend on besides its audio, as
+    recorded in the manifest.
+    """
+    return {"window": "hann", "window_length": 1024, "hop": 256, "nfft": 1024,
+            "activity_bins": config.activity_bins, "storage": config.feature_storage,
+            "version": feature_version}
+
+def file_hash(file_name, block_size=2**20):
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def source_entry(in_file, sha1=None):
+    """
+    The manifest entry of a track converted from in_file: its path, size,
+    modification time and content hash (computed unless given), and the
+    feature_params it was converted with.
+    """
+    stat = os.stat(in_file)
+    return {"source": os.path.abspath(in_file), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "sha1": sha1 or file_hash(in_file), "params": feature_params()}
+
+def read_manifest(hdf5_dir):
+    """
+    The manifest of the feature files of hdf5_dir: the source_entry of
+    every track, by output file name, and the fingerprint of the inputs
+    of the statistics last written from them.
+    """
+    manifest_file = os.path.join(hdf5_dir, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return {"tracks": {}, "stats": None}
+    with open(manifest_file) as in_file:
+        return json.load(in_file)
+
+def write_manifest(hdf5_dir, manifest):
+    manifest_file = os.path.join(hdf5_dir, 'manifest.json')
+    with open(manifest_file+'.tmp', 'w') as out_file:
+        json.dump(manifest, out_file, indent=1, sort_keys=True)
+    os.replace(manifest_file+'.tmp', manifest_file)
+
+def stats_fingerprint(manifest):
+    """
+    Hash of the sources and parameters of every track of manifest, which
+    changes exactly when statistics computed over them have to be.
+    """
+    inputs = sorted((name, entry["sha1"], entry["params"]) for name, entry in manifest["tracks"].items())
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+def plan_rebuild(wav_dir, hdf5_dir, manifest):
+    """
+    jobs, orphans = plan_rebuild(wav_dir, hdf5_dir, manifest)
+
+    Compares the stem.mp4 tracks of wav_dir with the feature files of
+    hdf5_dir and their manifest. jobs are the (in_file, out_file) pairs
+    of the tracks that are new, or whose audio or feature_params changed,
+    or whose feature file is missing or incomplete. The audio is only
+    hashed again when its size or modification time changed; a track that
+    was only touched just gets its manifest entry updated. orphans are the
+    feature files of tracks no longer in wav_dir.
+    """
+    wav_files = sorted(x for x in os.listdir(wav_dir) if x.endswith('.stem.mp4') and not x.startswith("."))
+    jobs = []
+    names = set()
     for lf in wav_files:
-        
-        # print(lf)
-        audio,fs = stempeg.read_stems(os.path.join(config.wav_dir_test,lf), stem_id=[0,1,2,3,4])
-
-        mixture = audio[0]
-
-        drums = audio[1]
-
-        bass = audio[2]
-
-        acc = audio[3]
-
-        vocals = audio[4]
-
-        mix_stft = utils.stft_stereo(mixture)
-
-        drums_stft = utils.stft_stereo(drums)
-
-        bass_stft = utils.stft_stereo(bass)
-
-        acc_stft = utils.stft_stereo(acc)
-
-        voc_stft = utils.stft_stereo(vocals)
-
-        hdf5_file = h5py.File(config.dir_hdf5_test+lf[:-9]+'.hdf5', mode='w')
-
-        shape_train = [config.channels, voc_stft.shape[1], config.features]
-
-        # import pdb;pdb.set_trace()
-
-        # hdf5_file.create_dataset("voc_stft", shape_train, np.float32)
-
-        hdf5_file.create_dataset("mix_stft", shape_train, np.float32)
-
-        # hdf5_file.create_dataset("drums_stft", shape_train, np.float32)
-
-        # hdf5_file.create_dataset("bass_stft", shape_train, np.float32)
-
-        # hdf5_file.create_dataset("acc_stft", shape_train, np.float32)
-
-        hdf5_file.create_dataset("tar_stft", [config.channels*4, voc_stft.shape[1], config.features], np.float32)
-
-        # hdf5_file["voc_stft"][:,:,:] = voc_stft
-
-        hdf5_file["mix_stft"][:,:,:] = mix_stft
-
-        # hdf5_file["drums_stft"][:,:,:] = drums_stft
-
-        # hdf5_file["bass_stft"][:,:,:] = bass_stft
-
-        # hdf5_file["acc_stft"][:,:,:] = acc_stft
-
-        hdf5_file["tar_stft"][:,:,:] = np.concatenate((voc_stft,drums_stft,bass_stft,acc_stft),axis = 0)
-
-        hdf5_file.close()
-
-
-        
-        
-
-        # np.save(config.dir_npy+lf[:-9]+'_voc_stft',voc_stft)
-
-        # np.save(config.dir_npy+lf[:-9]+'_mix_stft',mix_stft)
-
-        # np.save(config.dir_npy+lf[:-9]+'_drums_stft',drums_stft)
-
-        # np.save(config.dir_npy+lf[:-9]+'_bass_stft',bass_stft)
-
-        # np.save(config.dir_npy+lf[:-9]+'_acc_stft',acc_stft)
-
-
-        count+=1
-        utils.progress(count,len(wav_files))
-    import pdb;pdb.set_trace()
-
-
+        in_file = os.path.join(wav_dir, lf)
+        name = lf[:-9]+'.hdf5'
+        out_file = os.path.join(hdf5_dir, name)
+        names.add(name)
+
+        entry = manifest["tracks"].get(name)
+        if entry is None or entry["params"] != feature_params() or not is_converted(out_file):
+            jobs.append((in_file, out_file))
+            continue
+        stat = os.stat(in_file)
+        if (stat.st_size, stat.st_mtime_ns) != (entry["size"], entry["mtime_ns"]):
+            sha1 = file_hash(in_file)
+            if sha1 != entry["sha1"]:
+                jobs.append((in_file, out_file))
+            else:
+                manifest["tracks"][name] = source_entry(in_file, sha1)
+
+    converted = set(data_pipeline.feature_files(hdf5_dir))
+    orphans = sorted((converted | set(manifest["tracks"])) - names)
+    return jobs, orphans
+
+def _convert_job(job):
+    # a track that fails is reported with its error, so that the others
+    # are still converted and recorded in the manifest
+    in_file, out_file = job
+    try:
+        convert_track(in_file, out_file)
+        return out_file, source_entry(in_file), None
+    except Exception as error:
+        if os.path.exists(out_file+'.tmp'):
+            os.remove(out_file+'.tmp')
+        return out_file, None, "%s: %s" % (type(error).__name__, error)
+
+def main(workers=config.prep_workers, dirs=None):
+    """
+    Brings the feature files of the (stem directory, hdf5 directory) pairs
+    of dirs, the train and test sets by default, up to date with their
+    audio: new and changed tracks (see plan_rebuild) are converted with a
+    pool of worker processes and the feature files of removed tracks are
+    deleted. The manifest is updated as every track is converted, so an
+    interrupted run can simply be started again. Tracks that fail are
+    listed at the end and left out of the manifest, so the next run tries
+    them again. The normalisation statistics of the train set are then
+    written again from the ones stored with each track, if any of its
+    tracks changed. Returns the (in_file, error) of the failed tracks.
+    """
+    if dirs is None:
+        dirs = ((config.wav_dir_train, config.dir_hdf5), (config.wav_dir_test, config.dir_hdf5_test))
+
+    manifests = {}
+    jobs = []
+    for wav_dir, hdf5_dir in dirs:
+        manifests[hdf5_dir] = manifest = read_manifest(hdf5_dir)
+        dir_jobs, orphans = plan_rebuild(wav_dir, hdf5_dir, manifest)
+        for name in orphans:
+            print("Removing %s" % os.path.join(hdf5_dir, name))
+            if os.path.exists(os.path.join(hdf5_dir, name)):
+                os.remove(os.path.join(hdf5_dir, name))
+            manifest["tracks"].pop(name, None)
+        write_manifest(hdf5_dir, manifest)
+        jobs += [(in_file, out_file, hdf5_dir) for in_file, out_file in dir_jobs]
+
+    failed = []
+    if not jobs:
+        print("All tracks up to date")
+    else:
+        hdf5_dirs = dict((out_file, hdf5_dir) for in_file, out_file, hdf5_dir in jobs)
+        in_files = dict((out_file, in_file) for in_file, out_file, hdf5_dir in jobs)
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.imap_unordered(_convert_job, [(in_file, out_file) for in_file, out_file, hdf5_dir in jobs])
+            for count, (out_file, entry, error) in enumerate(results, 1):
+                if error is None:
+                    hdf5_dir = hdf5_dirs[out_file]
+                    manifests[hdf5_dir]["tracks"][os.path.basename(out_file)] = entry
+                    write_manifest(hdf5_dir, manifests[hdf5_dir])
+                else:
+                    failed.append((in_files[out_file], error))
+                utils.progress(count,len(jobs),suffix=os.path.basename(out_file))
+        except BaseException:
+            # KeyboardInterrupt included: don't wait for the queued tracks
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        print()
+        for in_file, error in failed:
+            print("Failed to convert %s: %s" % (in_file, error))
+
+    train_dir = dirs[0][1]
+    manifest = manifests[train_dir]
+    fingerprint = stats_fingerprint(manifest)
+    if manifest.get("stats") != fingerprint or not os.path.exists(config.stat_dir+'stats.hdf5'):
+        write_stats(train_dir, config.stat_dir)
+        manifest["stats"] = fingerprint
+        write_manifest(train_dir, manifest)
+
+    return failed
 
 
 if __name__ == '__main__':
-    main()
+    if '--consolidate' in sys.argv:
+        consolidate(config.dir_hdf5, config.h5py_file_train)
+        consolidate(config.dir_hdf5_test, config.h5py_file_val)
+    elif '--export-npy' in sys.argv:
+        export_npy(config.dir_hdf5, config.npy_dir_train)
+        export_npy(config.dir_hdf5_test, config.npy_dir_val)
+    elif '--storage-error' in sys.argv:
+        storage_error()
+    elif '--stats' in sys.argv:
+        write_stats()
+    elif '--index-activity' in sys.argv:
+        index_activity(config.dir_hdf5)
+        index_activity(config.dir_hdf5_test)
+    elif len(sys.argv) > 1:
+        sys.exit(1 if main(workers=int(sys.argv[1])) else 0)
+    else:
+        sys.exit(1 if main() else 0)
@@ -1,9 +1,16 @@
 import sys
 import os,re
 import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import csv
+import hashlib
+import json
+import subprocess
 import soundfile as sf
 import numpy as np
+import scipy.fft
+import h5py
 from scipy.stats import norm
 import pyworld as pw
 import matplotlib.pyplot as plt
@@ -12,8 +19,90 @@ import stempeg
 
 import config
 
+def get_dtype(dtype=None):
+    """
+    Returns the real dtype the DSP functions compute and return their
+    results in: dtype if given, config.dsp_dtype otherwise.
+
+    The default float32 policy (complex64 for complex spectra) halves the
+    memory and bandwidth of the double precision path, and is what the
+    model consumes anyway. Pass dtype=np.float64 to get the double
+    precision results of the original implementation. Float32 spectra
+    and resynthesised audio agree with float64 ones to within 1e-6 of
+    the signal's peak magnitude; only the padded tail istft returns past
+    the end of the original signal, where the window envelope vanishes,
+    is less accurate: within 1e-3 of the peak. check_dsp.py checks these
+    tolerances.
+    """
+    return np.dtype(config.dsp_dtype if dtype is None else dtype)
+
+def complex_dtype(dtype=None):
+    return np.result_type(get_dtype(dtype), np.complex64)
+
+def _rfft(frames, nfft):
+    # numpy's fft always computes in double precision, scipy keeps float32
+    if frames.dtype == np.float32:
+        return scipy.fft.rfft(frames, int(nfft), norm="ortho")
+    return np.fft.rfft(frames, int(nfft), norm="ortho")
+
+def _irfft(X, nfft):
+    if X.dtype == np.complex64:
+        return scipy.fft.irfft(X, int(nfft), norm="ortho")
+    return np.fft.irfft(X, int(nfft), norm="ortho")
+
+def stft_frames(lengthData, hopsize=256.0):
+    """
+    Number of frames stft returns for a signal of lengthData samples.
+    """
+    # should be the number of frames by YAAFE:
+    return int(np.ceil(lengthData / np.double(hopsize))) + 2
+
+def frame_signal(data, lengthWindow, hopsize, dtype=None):
+    """
+    frames = frame_signal(data, lengthWindow, hopsize)
+
+    Pads data the way stft does (half a window of zeros at the start, and
+    enough zeros at the end to hold an exact number of frames) and returns
+    all analysis frames as a read-only strided view, without copying them.
+
+    Inputs:
+        data                  :
+            array of shape (..., samples)
+        lengthWindow          :
+            size of each frame
+        hopsize               :
+            hopsize between consecutive frames (an integer number of samples)
+        dtype=None            :
+            dtype of the frames, see get_dtype
+    Outputs:
+        frames                :
+            array of shape (..., numberFrames, lengthWindow)
+    """
+    lengthData = data.shape[-1]
+
+    numberFrames = stft_frames(lengthData, hopsize)
+    # to ensure that the data array s big enough,
+    # assuming the first frame is centered on first sample:
+    newLengthData = int((numberFrames-1) * hopsize + lengthWindow)
+
+    # !!! adding zeros to the beginning of data, such that the first window is
+    # centered on the first sample of data, and zero-padding the end such
+    # that it holds an exact number of frames
+    padded = np.zeros(data.shape[:-1] + (newLengthData,), dtype=get_dtype(dtype))
+    padded[..., int(lengthWindow/2):int(lengthWindow/2)+lengthData] = data
+
+    return _strided_frames(padded, lengthWindow, hopsize, numberFrames)
+
+def _strided_frames(padded, lengthWindow, hopsize, numberFrames):
+    step = padded.strides[-1]
+    return np.lib.stride_tricks.as_strided(
+        padded,
+        shape=padded.shape[:-1] + (int(numberFrames), int(lengthWindow)),
+        strides=padded.strides[:-1] + (step*int(hopsize), step),
+        writeable=False)
+
 def stft(data, window=np.hanning(1024),
-         hopsize=256.0, nfft=1024.0, fs=44100.0):
+         hopsize=256.0, nfft=1024.0, fs=44100.0, dtype=None):
     """
     X, F, N = stft(data,window=sinebell(2048),hopsize=1024.0,
                    nfft=2048.0,fs=44100)
@@ -22,7 +111,8 @@ def stft(data, window=np.hanning(1024),
     
     Inputs:
         data                  :
-            one-dimensional time-series to be analyzed
+            one-dimensional time-series to be analyzed, or an array of
+            shape (channels, samples) holding several of them
         window=sinebell(2048) :
             analysis window
         hopsize=1024.0        :
@@ -32,69 +122,140 @@ def stft(data, window=np.hanning(1024),
             (the user has to provide an even number)
         fs=44100.0            :
             sampling rate of the signal
+        dtype=None            :
+            real dtype of the computation, see get_dtype; X has the
+            matching complex dtype
         
     Outputs:
         X                     :
-            STFT of data
-        F                     :
-            values of frequencies at each Fourier bins
-        N                     :
-            central time at the middle of each analysis
-            window
+            STFT of data, of shape (frames, nfft/2+1), or
+            (channels, frames, nfft/2+1) for multichannel data
     """
     
-    # window defines the size of the analysis windows
-    lengthWindow = window.size
-    
-    lengthData = data.size
-    
-    # should be the number of frames by YAAFE:
-    numberFrames = np.ceil(lengthData / np.double(hopsize)) + 2
-    # to ensure that the data array s big enough,
-    # assuming the first frame is centered on first sample:
-    newLengthData = (numberFrames-1) * hopsize + lengthWindow
+    # all the frames are taken as a strided view of the padded data, and
+    # transformed with a single batched FFT over (channels, frames, nfft)
+    frames = frame_signal(data, window.size, hopsize, dtype)
 
-    # import pdb;pdb.set_trace()
-    
-    # !!! adding zeros to the beginning of data, such that the first window is
-    # centered on the first sample of data
+    STFT = _rfft(frames*window.astype(frames.dtype), nfft)
 
-    # import pdb;pdb.set_trace()
-    data = np.concatenate((np.zeros(int(lengthWindow/2)), data))
-    
-    # zero-padding data such that it holds an exact number of frames
-
-    data = np.concatenate((data, np.zeros(int(newLengthData - data.size))))
-    
-    # the output STFT has nfft/2+1 rows. Note that nfft has to be an even
-    # number (and a power of 2 for the fft to be fast)
-    numberFrequencies = nfft / 2 + 1
-    
-    STFT = np.zeros([int(numberFrames), int(numberFrequencies)], dtype=complex)
-    
-    # storing FT of each frame in STFT:
-    for n in np.arange(numberFrames):
-        beginFrame = n*hopsize
-        endFrame = beginFrame+lengthWindow
-        frameToProcess = window*data[int(beginFrame):int(endFrame)]
-        STFT[int(n),:] = np.fft.rfft(frameToProcess, np.int32(nfft), norm="ortho")
-        
-    # frequency and time stamps:
-    F = np.arange(numberFrequencies)/np.double(nfft)*fs
-    N = np.arange(numberFrames)*hopsize/np.double(fs)
-    
     return STFT
 
+def stft_stream(blocks, window=np.hanning(1024),
+                hopsize=256.0, nfft=1024.0, fs=44100.0, dtype=None):
+    """
+    Generator version of stft, for signals too long to hold in memory.
+
+    blocks is an iterable of consecutive pieces of the signal, each of
+    shape (..., samples), of any length. The STFT frames are yielded as
+    soon as the samples they cover have been received, in blocks of shape
+    (..., frames, nfft/2+1). Concatenated along the frames axis they are
+    the same as stft of the whole signal: the samples of a frame that
+    overlap the next block are carried over, and the end of the signal is
+    padded the same way. Only the current block and the last window of
+    samples are held in memory.
+    """
+    lengthWindow = window.size
+    hop = int(hopsize)
+    window = window.astype(get_dtype(dtype))
+
+    buffer = None
+    lengthData = 0
+    emitted = 0
+
+    for block in blocks:
+        if buffer is None:
+            # first window centered on the first sample, as in stft
+            buffer = np.zeros(block.shape[:-1] + (int(lengthWindow/2),), dtype=window.dtype)
+        lengthData += block.shape[-1]
+        buffer = np.concatenate((buffer, block.astype(window.dtype)), axis=-1)
+
+        numberFrames = (buffer.shape[-1] - lengthWindow)//hop + 1
+        if numberFrames > 0:
+            frames = _strided_frames(buffer, lengthWindow, hop, numberFrames)
+            yield _rfft(frames*window, nfft)
+            emitted += numberFrames
+            buffer = buffer[..., numberFrames*hop:]
+
+    if buffer is None:
+        return
+
+    # zero-padding the end such that it holds an exact number of frames
+    numberFrames = stft_frames(lengthData, hopsize) - emitted
+    padded = np.zeros(buffer.shape[:-1] + ((numberFrames-1)*hop + lengthWindow,), dtype=window.dtype)
+    padded[..., :buffer.shape[-1]] = buffer
+    yield _rfft(_strided_frames(padded, lengthWindow, hop, numberFrames)*window, nfft)
+
+def stft_stereo_stream(blocks, phase=False, dtype=None):
+    """
+    Generator version of stft_stereo, for blocks of shape (samples, 2) such
+    as the ones soundfile.blocks reads.
+    """
+    for stft_lr in stft_stream((block.T for block in blocks), dtype=dtype):
+        if phase:
+            yield abs(stft_lr),np.angle(stft_lr)
+        else:
+            yield abs(stft_lr)
+
+def stft_stems(audio, mix_out=None, tar_out=None, block_frames=1024, dtype=None, stats=None,
+               storage='float32'):
+    """
+    mix_stft, tar_stft = stft_stems(audio)
+
+    Computes the magnitude features of a track in one pass: audio is the
+    (5, samples, 2) array returned by read_stems (mixture, drums,
+    bass, accompaniment, vocals), mix_stft is the (2, frames, 513) mixture
+    magnitude and tar_stft the (8, frames, 513) vocals, drums, bass and
+    accompaniment magnitudes, in the order data_gen expects.
+
+    All ten channels are transformed together, block_frames frames at a
+    time, and written into mix_out and tar_out, which can be preallocated
+    arrays or h5py datasets of the shapes above. If they are not given,
+    arrays of the storage dtype are allocated. dtype is the precision of the
+    computation, see get_dtype. stats, if given, is a FeatureStats updated
+    with every block as it is written. The magnitudes are written encoded
+    with encode_magnitudes(mag, storage).
+    """
+    # the ten channels padded as in frame_signal, copied straight from
+    # audio: mixture first, then the targets as vocals, drums, bass,
+    # accompaniment
+    lengthData = audio.shape[1]
+    numberFrames = stft_frames(lengthData, 256.0)
+    padded = np.zeros((10, (numberFrames-1)*256 + 1024), dtype=get_dtype(dtype))
+    for row, (stem, channel) in enumerate((stem, channel) for stem in (0, 4, 1, 2, 3) for channel in range(2)):
+        padded[row, 512:512+lengthData] = audio[stem, :, channel]
+
+    frames = _strided_frames(padded, 1024, 256.0, numberFrames)
+    window = np.hanning(1024).astype(frames.dtype)
+
+    if mix_out is None:
+        mix_out = np.zeros((2, numberFrames, 513), dtype=storage_dtype(storage))
+    if tar_out is None:
+        tar_out = np.zeros((8, numberFrames, 513), dtype=storage_dtype(storage))
+
+    for start in range(0, numberFrames, block_frames):
+        end = min(start + block_frames, numberFrames)
+        mag = abs(_rfft(frames[:, start:end]*window, 1024))
+        mix_out[:, start:end, :] = encode_magnitudes(mag[:2], storage)
+        tar_out[:, start:end, :] = encode_magnitudes(mag[2:], storage)
+        if stats is not None:
+            # the stored float32 values, targets first as in stats.hdf5
+            stats.update(np.roll(mag.astype(np.float32), -2, axis=0))
+
+    return mix_out, tar_out
+
 def istft(mag, phase, window=np.hanning(1024),
          hopsize=256.0, nfft=1024.0, fs=44100.0,
-          analysisWindow=None):
+          analysisWindow=None, dtype=None):
     """
     data = istft_norm(X,window=sinebell(2048),hopsize=1024.0,nfft=2048.0,fs=44100)
     Computes an inverse of the short time Fourier transform (STFT),
     here, the overlap-add procedure is implemented.
     Inputs:
-        X                     :
-            STFT of the signal, to be \"inverted\"
+        mag, phase            :
+            magnitude and phase of the STFT of the signal, to be
+            \"inverted\", of shape (frames, nfft/2+1). Any leading axes
+            (channels, stems) are inverted together and broadcast
+            against each other
         window=sinebell(2048) :
             synthesis window
             (should be the \"complementary\" window
@@ -104,6 +265,8 @@ def istft(mag, phase, window=np.hanning(1024),
         nfft=2048.0           :
             number of points for the Fourier computation
             (the user has to provide an even number)
+        dtype=None            :
+            real dtype of the computation and of data, see get_dtype
     Outputs:
         data                  :
             time series corresponding to the given STFT
@@ -111,50 +274,338 @@ def istft(mag, phase, window=np.hanning(1024),
             with the STFT computation given in the
             function stft
     """
-    X = mag * np.exp(1j*phase)
-    X = X.T
+    dtype = get_dtype(dtype)
+    X = (mag * np.exp(1j*phase)).astype(complex_dtype(dtype), copy=False)
+    if analysisWindow is None:
+        analysisWindow = window
+    window = window.astype(dtype)
+    analysisWindow = analysisWindow.astype(dtype)
+
+    lengthWindow = window.size
+    numberFrames = X.shape[-2]
+
+    # all the frames (of every channel and stem) are inverted at once
+    frames = _irfft(X, nfft)
+    frames = frames[..., :lengthWindow] * window
+
+    data = overlap_add(frames, hopsize)[..., int(lengthWindow/2.0):]
+
+    data = data / normalisation_envelope(numberFrames, hopsize,
+                                         window, analysisWindow)
+
+    return data
+
+def istft_stream(blocks, window=np.hanning(1024),
+                 hopsize=256.0, nfft=1024.0, fs=44100.0,
+                 analysisWindow=None, dtype=None):
+    """
+    Generator version of istft, for spectrograms too long to hold in memory.
+
+    blocks is an iterable of (mag, phase) pairs holding consecutive frames
+    of the STFT, each of shape (..., frames, nfft/2+1). Audio is yielded
+    in blocks of shape (..., samples) as soon as no later frame can
+    overlap it. Concatenated, they are exactly (bit for bit) the output
+    of istft on the whole spectrogram: the last frames of each block are
+    carried over, and every sample is overlap-added and normalised in the
+    same order istft uses.
+    """
+    dtype = get_dtype(dtype)
     if analysisWindow is None:
         analysisWindow = window
+    window = window.astype(dtype)
+    windowProduct = window * analysisWindow.astype(dtype)
+
+    lengthWindow = window.size
+    hop = int(hopsize)
+    # frames overlapping the first sample of a frame
+    numberCarried = int(np.ceil(lengthWindow / np.double(hop))) - 1
+    # the first half-window is removed, as in istft
+    toSkip = int(lengthWindow/2.0)
+
+    def normalise(data, normalisationSeq):
+        skip = min(toSkip, data.shape[-1])
+        normalisationSeq = normalisationSeq[skip:].copy()
+        normalisationSeq[normalisationSeq==0] = 1.
+        return data[..., skip:] / normalisationSeq, toSkip - skip
+
+    carry = None
+    for mag, phase in blocks:
+        X = (mag * np.exp(1j*phase)).astype(complex_dtype(dtype), copy=False)
+        frames = _irfft(X, nfft)[..., :lengthWindow] * window
+
+        numberOld = 0
+        if carry is not None:
+            numberOld = carry.shape[-2]
+            frames = np.concatenate((carry, frames), axis=-2)
+        numberFrames = frames.shape[-2]
+
+        # samples before the start of the next frame are complete
+        data = overlap_add(frames, hop)[..., numberOld*hop:numberFrames*hop]
+        normalisationSeq = overlap_add(
+            np.broadcast_to(windowProduct, (numberFrames, lengthWindow)), hop)
+        data, toSkip = normalise(data, normalisationSeq[numberOld*hop:numberFrames*hop])
+
+        carry = frames[..., max(numberFrames-numberCarried, 0):, :]
+        yield data
+
+    if carry is not None:
+        numberOld = carry.shape[-2]
+        data = overlap_add(carry, hop)[..., numberOld*hop:]
+        normalisationSeq = overlap_add(
+            np.broadcast_to(windowProduct, (numberOld, lengthWindow)), hop)
+        data, toSkip = normalise(data, normalisationSeq[numberOld*hop:])
+        yield data
+
+def overlap_add(frames, hopsize):
+    """
+    data = overlap_add(frames, hopsize)
+
+    Overlap-adds frames of shape (..., numberFrames, lengthWindow) spaced
+    by hopsize samples into signals of shape
+    (..., hopsize*(numberFrames-1) + lengthWindow).
+
+    Each frame is cut into blocks of hopsize samples, so the whole sum is
+    done with ceil(lengthWindow/hopsize) vectorised adds of shifted blocks
+    instead of one add per frame.
+    """
+    hopsize = int(hopsize)
+    numberFrames, lengthWindow = frames.shape[-2:]
+    numberBlocks = int(np.ceil(lengthWindow / np.double(hopsize)))
+    lengthData = hopsize*(numberFrames-1) + lengthWindow
 
-    lengthWindow = np.array(window.size)
-    numberFrequencies, numberFrames = X.shape
-    lengthData = int(hopsize*(numberFrames-1) + lengthWindow)
+    if numberBlocks*hopsize != lengthWindow:
+        pad = [(0, 0)]*(frames.ndim-1) + [(0, numberBlocks*hopsize-lengthWindow)]
+        frames = np.pad(frames, pad, mode='constant')
+    blocks = frames.reshape(frames.shape[:-1] + (numberBlocks, hopsize))
 
-    normalisationSeq = np.zeros(lengthData)
+    data = np.zeros(frames.shape[:-2] + (numberFrames+numberBlocks-1, hopsize),
+                    dtype=frames.dtype)
+    for b in range(numberBlocks):
+        data[..., b:b+numberFrames, :] += blocks[..., b, :]
 
-    data = np.zeros(lengthData)
+    data = data.reshape(frames.shape[:-2] + (-1,))
+    return data[..., :lengthData]
+
+def normalisation_envelope(numberFrames, hopsize, window, analysisWindow):
+    """
+    Returns the overlap-added window*analysisWindow sequence istft divides
+    by, with the first half-window removed and zeros replaced by ones.
+
+    The envelope only depends on the number of frames, the hopsize and the
+    windows, so it is computed once per combination and cached.
+    """
+    return _normalisation_envelope(int(numberFrames), int(hopsize),
+                                   window.tobytes(), analysisWindow.tobytes(),
+                                   window.dtype.str)
 
-    for n in np.arange(numberFrames):
-        beginFrame = int(n * hopsize)
-        endFrame = beginFrame + lengthWindow
-        frameTMP = np.fft.irfft(X[:,n], np.int32(nfft), norm = 'ortho')
-        frameTMP = frameTMP[:lengthWindow]
-        normalisationSeq[beginFrame:endFrame] = (
-            normalisationSeq[beginFrame:endFrame] +
-            window * analysisWindow)
-        data[beginFrame:endFrame] = (
-            data[beginFrame:endFrame] + window * frameTMP)
+@functools.lru_cache(maxsize=32)
+def _normalisation_envelope(numberFrames, hopsize, window, analysisWindow, dtype):
+    window = np.frombuffer(window, dtype=dtype)
+    analysisWindow = np.frombuffer(analysisWindow, dtype=dtype)
+    frames = np.broadcast_to(window*analysisWindow, (numberFrames, window.size))
 
-    data = data[int(lengthWindow/2.0):]
-    normalisationSeq = normalisationSeq[int(lengthWindow/2.0):]
+    normalisationSeq = overlap_add(frames, hopsize)[int(window.size/2.0):]
     normalisationSeq[normalisationSeq==0] = 1.
+    normalisationSeq.setflags(write=False)
 
-    data = data / normalisationSeq
+    return normalisationSeq
 
-    return data
+def get_dsp_backend(name=None):
+    """
+    Returns the module implementing stft, istft, stft_stereo, inverse_stft,
+    inverse_stft_write, generate_overlapadd and overlapadd, together with
+    asarray/to_numpy/to_model/from_model/stack to move data in and out
+    of it.
+
+    name is 'numpy' (this module) or 'torch' (dsp_torch), and defaults to
+    config.dsp_backend.
+    """
+    if name is None:
+        name = config.dsp_backend
+    if name == 'numpy':
+        return sys.modules[__name__]
+    elif name == 'torch':
+        import dsp_torch
+        return dsp_torch
+    raise ValueError("Unknown DSP backend %s" % name)
+
+def asarray(data):
+    return np.asarray(data)
 
-def stft_stereo(data, phase=False):
+def to_numpy(data):
+    return np.asarray(data)
+
+def from_model(output):
+    return output.data.cpu().numpy()
+
+def stack(arrays):
+    return np.array(arrays)
+
+def to_model(batch):
+    import torch
+    return torch.from_numpy(np.array(batch, dtype=np.float32))
+
+def stft_stereo(data, phase=False, dtype=None):
     assert data.shape[1] == 2
+    stft_lr = stft(data.T, dtype=dtype)
     if phase:
-        stft_left = stft(data[:,0])
-        stft_right = stft(data[:,1])
-        return np.array([abs(stft_left),abs(stft_right)]),np.array([np.angle(stft_left),np.angle(stft_right)])
+        return abs(stft_lr),np.angle(stft_lr)
     else:
-        stft_left = abs(stft(data[:,0]))
-        stft_right = abs(stft(data[:,1]))
-        return np.array([stft_left,stft_right])
+        return abs(stft_lr)
 
 
+def stem_cache_dir(file_name):
+    """
+    Directory of config.audio_cache_dir holding the decoded stems of
+    file_name. It is keyed by the file's path, size and modification time,
+    so a changed file is decoded again.
+    """
+    file_stat = os.stat(file_name)
+    key = '%s|%d|%d' % (os.path.abspath(file_name), file_stat.st_size, file_stat.st_mtime_ns)
+    return os.path.join(config.audio_cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+def save_atomic(file_name, array):
+    """
+    np.save that writes to a temporary file and renames it, so readers
+    never see a partially written file.
+    """
+    tmp_name = '%s.%d.tmp' % (file_name, os.getpid())
+    with open(tmp_name, 'wb') as tmp_file:
+        np.save(tmp_file, array)
+    os.replace(tmp_name, file_name)
+
+def _decode_command(file_name, stem, rate, channels):
+    return ['ffmpeg', '-nostdin', '-vn', '-i', file_name, '-map', '0:%d' % stem,
+            '-f', 's16le', '-acodec', 'pcm_s16le', '-ar', str(rate), '-ac', str(channels),
+            '-loglevel', 'error', '-']
+
+def _decode_stem(file_name, stem, rate, channels):
+    cmd = _decode_command(file_name, stem, rate, channels)
+    pcm = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+    return np.frombuffer(pcm, dtype=np.int16).reshape(-1, channels)
+
+def _decode_pcm(file_name, stems, threads):
+    info = stempeg.Info(file_name)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pcm = list(pool.map(lambda stem: _decode_stem(file_name, stem, info.rate(stem), info.channels(stem)),
+                            stems))
+    return pcm, info.rate(stems[0])
+
+def _pcm_to_float(pcm):
+    # stempeg shortens stems of different lengths to the shortest one
+    length = min(stem_pcm.shape[0] for stem_pcm in pcm)
+    audio = np.empty((len(pcm), length, pcm[0].shape[1]), dtype=np.float32)
+    for stem_audio, stem_pcm in zip(audio, pcm):
+        np.multiply(stem_pcm[:length], np.float32(1.0/32768), out=stem_audio)
+    return audio
+
+def decode_stems(file_name, stem_id=[0,1,2,3,4], threads=config.decode_threads):
+    """
+    audio, fs = decode_stems(file_name, stem_id=[0,1,2,3,4])
+
+    Decodes the stems stem_id of the stem.mp4 file file_name like
+    stempeg.read_stems(file_name, stem_id=stem_id), but every stem in its
+    own ffmpeg process, up to threads of them at once, and straight from
+    ffmpeg's 16 bit output into a single preallocated float32 array of
+    shape (stems, samples, 2), instead of one stem after the other through
+    temporary wav files. As with stempeg, stems of different lengths are
+    shortened to the shortest one and a single stem_id gives an array of
+    shape (samples, 2). Only the requested stems are decoded.
+    """
+    stems = list(stem_id) if isinstance(stem_id, (list, tuple)) else [stem_id]
+    pcm, fs = _decode_pcm(file_name, stems, threads)
+    audio = _pcm_to_float(pcm)
+    if not isinstance(stem_id, (list, tuple)):
+        return audio[0], fs
+    return audio, fs
+
+def read_stems(file_name, stem_id=[0,1,2,3,4]):
+    """
+    audio, fs = read_stems(file_name, stem_id=[0,1,2,3,4])
+
+    Same as stempeg.read_stems(file_name, stem_id=stem_id), but the stems
+    are decoded in parallel with decode_stems, and the decoded 16 bit PCM
+    of every stem is kept as a .npy file under config.audio_cache_dir
+    (see stem_cache_dir), so only the first read of a stem runs ffmpeg.
+    Ask only for the stems you need: stem_id=0 decodes the mixture alone.
+
+    The cache takes as much space as the uncompressed audio (about 30 GB
+    for all the stems of MUSDB) and is never cleaned up: it is meant for
+    the files that are separated or evaluated repeatedly, prep_data
+    decodes without it. The stems are returned as float32, scaled from
+    the cached PCM, which float32 represents exactly, of shape (samples, 2)
+    for a single stem_id as with decode_stems. Set config.audio_cache_dir
+    to None to always decode.
+    """
+    if config.audio_cache_dir is None:
+        return decode_stems(file_name, stem_id=stem_id)
+
+    cache_dir = stem_cache_dir(file_name)
+    stems = list(stem_id) if isinstance(stem_id, (list, tuple)) else [stem_id]
+    stem_files = [os.path.join(cache_dir, 'pcm_%d.npy' % stem) for stem in stems]
+    info_file = os.path.join(cache_dir, 'info.json')
+
+    missing = [stem for stem, stem_file in zip(stems, stem_files) if not os.path.exists(stem_file)]
+    if missing or not os.path.exists(info_file):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        if missing:
+            pcm, fs = _decode_pcm(file_name, missing, config.decode_threads)
+            for stem, stem_pcm in zip(missing, pcm):
+                save_atomic(os.path.join(cache_dir, 'pcm_%d.npy' % stem), stem_pcm)
+        else:
+            # the stems are cached, only the rate is needed
+            fs = stempeg.Info(file_name).rate(stems[0])
+        tmp_name = '%s.%d.tmp' % (info_file, os.getpid())
+        with open(tmp_name, 'w') as info:
+            json.dump({'file_name': os.path.abspath(file_name), 'fs': fs}, info)
+        os.replace(tmp_name, info_file)
+
+    with open(info_file) as info:
+        fs = json.load(info)['fs']
+
+    audio = _pcm_to_float([np.load(stem_file, mmap_mode='r') for stem_file in stem_files])
+    if not isinstance(stem_id, (list, tuple)):
+        return audio[0], fs
+    return audio, fs
+
+def read_stem_blocks(file_name, stem_id=0, block_samples=2**20):
+    """
+    Generator version of read_stems for a single stem, for the files too
+    long to hold in memory: yields the float32 audio of the stem stem_id
+    of file_name in consecutive blocks of shape (block_samples, channels),
+    the last one shorter. The blocks are read from the audio cache of
+    read_stems if the stem is in it, and otherwise straight from ffmpeg's
+    output as it decodes, without being cached.
+    """
+    if config.audio_cache_dir is not None:
+        stem_file = os.path.join(stem_cache_dir(file_name), 'pcm_%d.npy' % stem_id)
+        if os.path.exists(stem_file):
+            pcm = np.load(stem_file, mmap_mode='r')
+            for start in range(0, pcm.shape[0], block_samples):
+                yield _pcm_to_float([pcm[start:start+block_samples]])[0]
+            return
+
+    info = stempeg.Info(file_name)
+    channels = info.channels(stem_id)
+    cmd = _decode_command(file_name, stem_id, info.rate(stem_id), channels)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        while True:
+            pcm = process.stdout.read(block_samples*channels*2)
+            if not pcm:
+                break
+            yield _pcm_to_float([np.frombuffer(pcm, dtype=np.int16).reshape(-1, channels)])[0]
+    except BaseException:
+        # the generator was closed early, or failed
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
 def progress(count, total, suffix=''):
     bar_len = 60
     filled_len = int(round(bar_len * count / float(total)))
@@ -191,68 +642,389 @@ def file_to_stft(input_file):
 
 
 
-def generate_overlapadd(allmix,time_context=config.max_phr_len, overlap=config.max_phr_len/2,batch_size=config.batch_size):
-    #window = np.sin((np.pi*(np.arange(2*overlap+1)))/(2.0*overlap))
-    input_size = allmix.shape[-1]
+def generate_overlapadd(allmix,time_context=config.max_phr_len, overlap=config.max_phr_len/2,batch_size=config.batch_size,dtype=None):
+    """
+    fbatch, nchunks = generate_overlapadd(allmix)
+
+    Cuts the spectrogram allmix, of shape (2, frames, 513), into chunks of
+    time_context frames overlapping by overlap frames, grouped in batches:
+    fbatch has shape (n_batches, batch_size, 2, time_context, 513) and
+    nchunks is the number of real chunks in it.
+
+    fbatch is a read-only strided view, so the overlapping chunks are not
+    copied: they all share a single copy of allmix in dtype (see
+    get_dtype). That copy is padded with 1e-10 frames after the end of the
+    spectrogram so the last batch is complete. The padding chunks at the
+    end of that batch (from nchunks on) partly overlap the last real
+    chunk and are ignored by overlapadd.
+    """
+    step = int(time_context - overlap)
+    channels, numberFrames, input_size = allmix.shape
 
-    i=0
-    start=0  
-    while (start + time_context) < allmix.shape[1]:
-        i = i + 1
-        start = start - overlap + time_context 
-    fbatch = np.zeros([int(np.ceil(float(i)/batch_size)),batch_size,2,time_context,input_size])+1e-10
-    
-    
-    i=0
-    start=0  
+    # a chunk starting at start is only taken if start + time_context is
+    # strictly before the last frame
+    nchunks = max(int(np.ceil((numberFrames - time_context)/float(step))), 0)
+    nbatches = int(np.ceil(float(nchunks)/batch_size))
 
-    while (start + time_context) < allmix.shape[1]:
-        fbatch[int(i/batch_size),int(i%batch_size),:,:,:]=allmix[:,int(start):int(start+time_context),:]
-        i = i + 1 #index for each block
-        start = start - overlap + time_context #starting point for each block
-    
-    return fbatch,i
+    if nbatches == 0:
+        return np.zeros((0,batch_size,channels,time_context,input_size),dtype=get_dtype(dtype)),0
+
+    lengthPadded = (nbatches*batch_size-1)*step + time_context
+    padded = np.full((channels,lengthPadded,input_size), 1e-10, dtype=get_dtype(dtype))
+    padded[:,:min(lengthPadded,numberFrames)] = allmix[:,:lengthPadded]
 
-def overlapadd(fbatch,nchunks,overlap=int(config.max_phr_len/2)):
+    s0, s1, s2 = padded.strides
+    fbatch = np.lib.stride_tricks.as_strided(
+        padded,
+        shape=(nbatches,batch_size,channels,time_context,input_size),
+        strides=(batch_size*step*s1,step*s1,s0,s1,s2),
+        writeable=False)
 
+    return fbatch,nchunks
+
+def generate_overlapadd_stream(frame_blocks,time_context=config.max_phr_len, overlap=config.max_phr_len/2,batch_size=config.batch_size,dtype=None):
+    """
+    Generator version of generate_overlapadd, for the frame blocks of shape
+    (2, frames, 513) produced by stft_stereo_stream.
+
+    Yields (fbatch, n) pairs: fbatch holds batch_size chunks of shape
+    (2, time_context, 513), and n is the number of real chunks in it, which
+    is only smaller than batch_size for the last batch. The chunks, padding
+    chunks included, are the same as the ones generate_overlapadd takes
+    from the whole spectrogram, and only the frames not yet covered by a
+    full chunk are held between blocks.
+    """
+    step = int(time_context - overlap)
+    buffer = None
+    batch = []
+
+    for block in frame_blocks:
+        buffer = block if buffer is None else np.concatenate((buffer, block), axis=1)
+
+        # a chunk starting at start is only taken if start + time_context
+        # is strictly before the last frame
+        while buffer.shape[1] > time_context:
+            batch.append(buffer[:, :time_context])
+            buffer = buffer[:, step:]
+            if len(batch) == batch_size:
+                yield np.array(batch, dtype=get_dtype(dtype)),batch_size
+                batch = []
+
+    if batch:
+        # the padding chunks carry on over the remaining frames, then 1e-10,
+        # as in generate_overlapadd
+        nchunks = len(batch)
+        lengthPadded = (batch_size-nchunks-1)*step + time_context
+        padded = np.full((buffer.shape[0],lengthPadded,buffer.shape[2]), 1e-10, dtype=get_dtype(dtype))
+        padded[:,:min(lengthPadded,buffer.shape[1])] = buffer[:,:lengthPadded]
+        for start in range(0, lengthPadded-time_context+1, step):
+            batch.append(padded[:, start:start+time_context])
+        yield np.array(batch, dtype=get_dtype(dtype)),nchunks
+
+def overlapadd_stream(batches,overlap=int(config.max_phr_len/2),dtype=None):
+    """
+    Generator version of overlapadd, for the (fbatch, n) pairs of
+    generate_overlapadd_stream once they have been through the model:
+    fbatch of shape (..., batch_size, 2, time_context, 513), of which the
+    first n chunks are used. Frame blocks of shape (..., 2, frames, 513)
+    are yielded as soon as no later chunk overlaps them. Concatenated,
+    they are the output of overlapadd on all the chunks (nothing is
+    yielded if there are none), and only the last chunk is held between
+    batches.
+
+    As in overlapadd, when chunks overlap by half their length the
+    crossfades of a whole batch are done in one vectorised expression.
+    """
+    dtype = get_dtype(dtype)
+    fade_in, fade_out = crossfade_window(overlap, dtype)
+    # the last chunk, and the frames of the output it covers that are not
+    # final yet
+    last = None
+    tail = None
+
+    for fbatch, n in batches:
+        time_context = fbatch.shape[-2]
+        step = time_context - overlap
+        chunks = fbatch[...,:n,:,:,:]
+        if n == 0:
+            continue
+
+        if time_context == 2*overlap:
+            # every chunk completes the frames before its second half,
+            # crossfaded as in overlapadd
+            first = chunks[...,:overlap,:]
+            faded = np.empty(first.shape, dtype=dtype)
+            if last is None:
+                faded[...,0,:,:,:] = first[...,0,:,:,:]
+                np.multiply(fade_out, chunks[...,:-1,:,overlap:,:], out=faded[...,1:,:,:,:])
+                faded[...,1:,:,:,:] += fade_in*first[...,1:,:,:,:]
+            else:
+                second = np.concatenate((last[...,np.newaxis,:,overlap:,:], chunks[...,:-1,:,overlap:,:]), axis=-4)
+                np.multiply(fade_out, second, out=faded)
+                faded += fade_in*first
+            yield np.moveaxis(faded,-4,-3).reshape(faded.shape[:-4]+(faded.shape[-3],n*overlap,faded.shape[-1]))
+            last = np.array(chunks[...,-1,:,:,:])
+            tail = last[...,overlap:,:].astype(dtype)
+        else:
+            for i in range(n):
+                sa = chunks[...,i,:,:,:]
+                if tail is None:
+                    tail = np.array(sa, dtype=dtype)
+                else:
+                    # the frames before this chunk are final
+                    yield tail[...,:step,:]
+                    faded = (fade_out*tail[...,step:,:] + fade_in*sa[...,:overlap,:]).astype(dtype)
+                    tail = np.concatenate((faded, sa[...,overlap:,:].astype(dtype)), axis=-2)
+
+    if tail is not None:
+        yield tail
+        # overlapadd leaves room for one more step after the last chunk
+        yield np.zeros(tail.shape[:-2]+(step,tail.shape[-1]), dtype=dtype)
+
+def pair_phase(blocks, phases):
+    """
+    Pairs the consecutive frame blocks of shape (..., frames, 513) with the
+    phase of the same frames, taken from phases, a deque of consecutive
+    phase blocks of shape (..., frames, 513) that is filled while blocks
+    is consumed, and yields (block, phase) pairs. Frames of blocks past
+    the end of the phase are dropped.
+    """
+    for block in blocks:
+        start = 0
+        while start < block.shape[-2]:
+            if not phases:
+                break
+            frames = min(block.shape[-2] - start, phases[0].shape[-2])
+            yield block[...,start:start+frames,:], phases[0][...,:frames,:]
+            if frames == phases[0].shape[-2]:
+                phases.popleft()
+            else:
+                phases[0] = phases[0][...,frames:,:]
+            start += frames
+
+@functools.lru_cache(maxsize=8)
+def crossfade_window(overlap, dtype):
+    """
+    Returns the linear (fade_in, fade_out) crossfade weights overlapadd
+    applies to the overlap frames, as read-only (overlap, 1) columns that
+    broadcast over the frequency bins.
+    """
+    fade_in = np.linspace(0., 1.0, num=overlap, dtype=dtype)[:,np.newaxis]
+    fade_out = fade_in[::-1]
+    fade_in.setflags(write=False)
+    return fade_in, fade_out
+
+def overlapadd(fbatch,nchunks,overlap=int(config.max_phr_len/2),dtype=None):
+    """
+    sep = overlapadd(fbatch, nchunks)
+
+    Inverse of generate_overlapadd: puts the first nchunks chunks of fbatch,
+    of shape (..., n_batches, batch_size, 2, time_context, 513), back
+    together into spectrograms of shape (..., 2, frames, 513), linearly
+    crossfading the overlapping frames of consecutive chunks. Any leading
+    axes (e.g. stems) are reassembled together.
+
+    When chunks overlap by half their length, which is how
+    generate_overlapadd cuts them, every crossfade only involves two
+    chunks and they are all done in one vectorised expression.
+    """
+    dtype = get_dtype(dtype)
     input_size=fbatch.shape[-1]
     time_context=fbatch.shape[-2]
-    batch_size=fbatch.shape[1]
+    channels=fbatch.shape[-3]
+    lead=fbatch.shape[:-5]
 
+    fade_in, fade_out = crossfade_window(overlap, dtype)
 
-    #window = np.sin((np.pi*(np.arange(2*overlap+1)))/(2.0*overlap))
-    window = np.linspace(0., 1.0, num=overlap)
-    window = np.concatenate((window,window[::-1]))
-    #time_context = net.network.find('hid2', 'hh').size
-    # input_size = net.layers[0].size  #input_size is the number of spectral bins in the fft
-    window = np.repeat(np.expand_dims(window, axis=1),input_size,axis=1)
-    
+    chunks = fbatch.reshape(lead+(-1,channels,time_context,input_size))[...,:nchunks,:,:,:]
 
-    sep = np.zeros((2,int(nchunks*(time_context-overlap)+time_context),input_size))
+    sep = np.zeros(lead+(channels,int(nchunks*(time_context-overlap)+time_context),input_size),dtype=dtype)
 
-    # import pdb;pdb.set_trace()
+    if nchunks == 0:
+        return sep
 
-    
-    i=0
-    start=0 
-    while i < nchunks:
-        # import pdb;pdb.set_trace()
-        sa = fbatch[int(i/batch_size),int(i%batch_size),:,:,:]
-        # import pdb;pdb.set_trace()
+    if time_context == 2*overlap:
+        first = chunks[...,:overlap,:]
+        second = chunks[...,overlap:,:]
+        # sep seen as consecutive blocks of overlap frames, chunk axis first
+        blocks = np.moveaxis(sep.reshape(lead+(channels,nchunks+2,overlap,input_size)),-3,-4)
+        blocks[...,0,:,:,:] = first[...,0,:,:,:]
+        faded = blocks[...,1:nchunks,:,:,:]
+        np.multiply(fade_out, second[...,:-1,:,:,:], out=faded)
+        faded += fade_in*first[...,1:,:,:,:]
+        blocks[...,nchunks,:,:,:] = second[...,-1,:,:,:]
+        return sep
 
-        #print s1.shape
+    start=0
+    for i in range(nchunks):
+        sa = chunks[...,i,:,:,:]
         if start==0:
-            sep[:,0:time_context,:] = sa
-
+            sep[...,0:time_context,:] = sa
         else:
-            #print start+overlap
-            #print start+time_context
-            sep[:,int(start+overlap):int(start+time_context),:] = sa[:,overlap:time_context]
-            # import pdb;pdb.set_trace()
-            sep[:,start:int(start+overlap),:] = window[overlap:]*sep[:,start:int(start+overlap),:] + window[:overlap]*sa[:,:overlap]
-        i = i + 1 #index for each block
+            sep[...,start+overlap:start+time_context,:] = sa[...,overlap:time_context,:]
+            sep[...,start:start+overlap,:] = fade_out*sep[...,start:start+overlap,:] + fade_in*sa[...,:overlap,:]
         start = int(start - overlap + time_context) #starting point for each block
-    return sep  
+    return sep
+
+
+class FeatureStats(object):
+    """
+    Streaming statistics of the magnitude features, per channel and bin:
+    the maximum, minimum, mean and variance (Welford) of the 10 channels
+    in the order of stats.hdf5, the 8 target channels (tar_stft) then the
+    2 mixture ones (mix_stft). They are updated a block of frames at a
+    time, and the statistics of different tracks or workers can be merged,
+    so the whole dataset never has to be read at once, or read again.
+    """
+    def __init__(self, channels=config.channels*5, features=config.features):
+        self.count = 0
+        self.maximus = np.full((channels, features), -np.inf)
+        self.minimus = np.full((channels, features), np.inf)
+        self.means = np.zeros((channels, features))
+        self.m2 = np.zeros((channels, features))
+
+    def update(self, feats):
+        """
+        Adds the frames of feats, of shape (channels, frames, features).
+        """
+        if feats.shape[1] == 0:
+            return
+        block = FeatureStats(*self.means.shape)
+        block.count = feats.shape[1]
+        block.maximus = feats.max(axis=1)
+        block.minimus = feats.min(axis=1)
+        block.means = feats.mean(axis=1, dtype=np.float64)
+        block.m2 = ((feats-block.means[:, None, :])**2).sum(axis=1)
+        self.merge(block)
+
+    def update_track(self, tar_stft, mix_stft, block_frames=4096):
+        """
+        Adds every frame of a track, read block_frames at a time from its
+        tar_stft and mix_stft (arrays or h5py datasets).
+        """
+        for start in range(0, mix_stft.shape[1], block_frames):
+            self.update(np.concatenate((tar_stft[:, start:start+block_frames, :],
+                                        mix_stft[:, start:start+block_frames, :]), axis=0))
+
+    def merge(self, other):
+        """
+        Adds the frames counted by the FeatureStats other.
+        """
+        count = self.count + other.count
+        if other.count == 0:
+            return self
+        delta = other.means - self.means
+        self.means = self.means + delta*(float(other.count)/count)
+        self.m2 = self.m2 + other.m2 + delta**2*(float(self.count)*other.count/count)
+        self.maximus = np.maximum(self.maximus, other.maximus)
+        self.minimus = np.minimum(self.minimus, other.minimus)
+        self.count = count
+        return self
+
+    @property
+    def stds(self):
+        return np.sqrt(self.m2/max(self.count, 1))
+
+    def write(self, group):
+        """
+        Stores the accumulators in the h5py group, see read.
+        """
+        group.attrs['count'] = self.count
+        for name in ("maximus", "minimus", "means", "m2"):
+            if name in group:
+                del group[name]
+            group.create_dataset(name, data=getattr(self, name))
+
+    @classmethod
+    def read(cls, group):
+        stats = cls(*group["means"].shape)
+        stats.count = int(group.attrs['count'])
+        for name in ("maximus", "minimus", "means", "m2"):
+            setattr(stats, name, np.array(group[name]))
+        return stats
+
+    def save(self, stat_dir=config.stat_dir, feat='feats'):
+        """
+        Writes stats.hdf5 to stat_dir, with the feat_maximus and
+        feat_minimus datasets data_gen reads and feat_means and feat_stds,
+        and the same arrays as the feat_*.npy files normalize reads.
+        """
+        stats = dict(maximus=self.maximus, minimus=self.minimus, means=self.means, stds=self.stds)
+        tmp_file = stat_dir+'stats.hdf5.tmp'
+        with h5py.File(tmp_file, mode='w') as hdf5_file:
+            hdf5_file.attrs['count'] = self.count
+            for name, stat in stats.items():
+                hdf5_file.create_dataset(feat+'_'+name, data=stat.astype(np.float32))
+        os.replace(tmp_file, stat_dir+'stats.hdf5')
+        for name, stat in stats.items():
+            save_atomic(stat_dir+feat+'_'+name+'.npy', stat.astype(np.float32))
+
+
+# range of the 'log_uint16' magnitude storage, see encode_magnitudes; the
+# magnitudes of a full scale signal stay below 16 with the "ortho" stft
+log_uint16_floor = 1e-5
+log_uint16_max = 16.0
+
+def storage_dtype(storage=None):
+    storage = config.feature_storage if storage is None else storage
+    return np.dtype({'float32': np.float32, 'float16': np.float16, 'log_uint16': np.uint16}[storage])
+
+def encode_magnitudes(mag, storage=None):
+    """
+    The magnitudes mag as stored with storage, config.feature_storage by
+    default: 'float32', 'float16' (half the size, with a relative error
+    of about 5e-4) or 'log_uint16', log1p(mag/log_uint16_floor) quantised
+    on 16 bits up to log_uint16_max (the same size as float16, with a
+    relative error of about 1e-4 above the floor).
+    """
+    storage = config.feature_storage if storage is None else storage
+    if storage == 'log_uint16':
+        scale = 65535/np.log1p(log_uint16_max/log_uint16_floor)
+        mag = np.clip(mag, 0, log_uint16_max)
+        return np.rint(np.log1p(mag/log_uint16_floor)*scale).astype(np.uint16)
+    return np.asarray(mag).astype(storage_dtype(storage))
+
+def decode_magnitudes(stored, storage=None):
+    """
+    Inverse of encode_magnitudes, as float32.
+    """
+    storage = config.feature_storage if storage is None else storage
+    if storage == 'log_uint16':
+        scale = np.log1p(log_uint16_max/log_uint16_floor)/65535
+        return (log_uint16_floor*np.expm1(stored*scale)).astype(np.float32)
+    return np.asarray(stored).astype(np.float32, copy=False)
+
+class StoredFeature(object):
+    """
+    A feature stored with encode_magnitudes (an h5py dataset, whose
+    storage attribute says how, or a memory-mapped array of the given
+    storage), sliced like the original float32 array: slices are decoded
+    as they are read.
+    """
+    def __init__(self, stored, storage=None):
+        self.stored = stored
+        if storage is None:
+            storage = stored.attrs.get('storage', 'float32') if hasattr(stored, 'attrs') else 'float32'
+        self.storage = storage.decode('utf-8') if isinstance(storage, bytes) else storage
+        self.shape = stored.shape
+
+    def __getitem__(self, key):
+        if self.storage == 'float32':
+            return self.stored[key]
+        return decode_magnitudes(self.stored[key], self.storage)
+
+    def read_into(self, out, key):
+        """
+        Reads self[key] straight into the C-contiguous float32 array out:
+        float32 and float16 h5py datasets with read_direct (HDF5 converts
+        float16 itself), without an intermediate array.
+        """
+        if self.storage == 'log_uint16':
+            out[...] = self[key]
+        elif hasattr(self.stored, 'read_direct'):
+            self.stored.read_direct(out, key)
+        else:
+            out[...] = self.stored[key]
 
 
 def normalize(inputs, feat, mode=config.norm_mode_in):
@@ -271,23 +1043,64 @@ def normalize(inputs, feat, mode=config.norm_mode_in):
 
     return outputs
 
-def inverse_stft_write(mix_stft,mix_phase,file_name):
-    audio_out_l = istft(mix_stft[0],mix_phase[0])
+def inverse_stft_write(mix_stft,mix_phase,file_name,block_frames=config.synth_block_frames,subtype=None):
+    """
+    Resynthesises stereo magnitudes mix_stft of shape (2, frames, 513) with
+    mix_phase and writes them to file_name, block_frames frames at a time
+    into an open sound file, so the whole track is never held in memory.
+    The file is the same as writing inverse_stft's output with sf.write.
+    """
+    blocks = ((mix_stft[:, start:start+block_frames], mix_phase[:, start:start+block_frames])
+              for start in range(0, mix_stft.shape[1], block_frames))
 
-    audio_out_r = istft(mix_stft[1],mix_phase[1])
+    inverse_stft_write_stream(blocks,file_name,subtype)
 
-    audio_out = np.array([audio_out_l,audio_out_r]).T  
+def inverse_stft_write_stream(blocks,file_name,subtype=None):
+    """
+    Resynthesises consecutive (mag, phase) blocks of shape (2, frames, 513)
+    with istft_stream and appends the audio to file_name as it goes.
+    """
+    with sf.SoundFile(file_name, 'w', samplerate=config.fs, channels=2, subtype=subtype) as out_file:
+        for audio_out in istft_stream(blocks):
+            out_file.write(audio_out.T)
 
-    sf.write(file_name,audio_out,config.fs)
+def write_stems_stream(blocks,file_names,subtype=None):
+    """
+    Resynthesises consecutive (stems, phase) blocks, stems of shape
+    (len(file_names), 2, frames, 513) sharing the phase of shape
+    (2, frames, 513), with a single istft_stream and appends the audio of
+    each stem to its file as it goes.
+    """
+    out_files = [sf.SoundFile(file_name, 'w', samplerate=config.fs, channels=2, subtype=subtype)
+                 for file_name in file_names]
+    try:
+        for audio_out in istft_stream(blocks):
+            for out_file, stem_audio in zip(out_files, audio_out):
+                out_file.write(stem_audio.T)
+    finally:
+        for out_file in out_files:
+            out_file.close()
+
+def write_stems(stems,mix_phase,file_names,threads=config.synth_threads):
+    """
+    Writes each of the stereo magnitudes in stems with inverse_stft_write,
+    sharing mix_phase, from a pool of threads.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        writes = [pool.submit(inverse_stft_write,stem,mix_phase,file_name)
+                  for stem, file_name in zip(stems,file_names)]
+        for write in writes:
+            write.result()
 
 def inverse_stft(mix_stft,mix_phase):
-    audio_out_l = istft(mix_stft[0],mix_phase[0])
-
-    audio_out_r = istft(mix_stft[1],mix_phase[1])
-
-    audio_out = np.array([audio_out_l,audio_out_r]).T
+    """
+    Resynthesises stereo magnitudes mix_stft of shape (..., 2, frames, 513)
+    with mix_phase into audio of shape (..., samples, 2). Several stems can
+    be stacked on the leading axis and share the same phase.
+    """
+    audio_out = istft(mix_stft,mix_phase)
 
-    return audio_out
+    return np.swapaxes(audio_out,-1,-2)
 
 
 def denormalize(inputs, feat, mode=config.norm_mode_in):
@@ -305,9 +1118,7 @@ def denormalize(inputs, feat, mode=config.norm_mode_in):
 
 def main():
     lf = "Al James - Schoolboy Facination.stem.mp4"
-    audio,fs = stempeg.read_stems(os.path.join(config.wav_dir_test,lf), stem_id=[0,1,2,3,4])
-
-    mixture = audio[0]
+    mixture,fs = read_stems(os.path.join(config.wav_dir_test,lf),stem_id=0)
 
     mix_stft, mix_phase = stft_stereo(mixture,phase=True)
 